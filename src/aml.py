@@ -1,15 +1,20 @@
 ''' Aml is a pre/post-processor for shpaml. It extends shpaml syntax
-with shortcuts useful when shpaml output is a jinja template.
+with shortcuts useful when shpaml output is a template, for example
+a jinja template.
 
 Aml module can be imported into a Python program and used as follows:
 
-import aml
-jinja_template_text = aml.convert_text(aml_template_text)
+import aml, aml_jinja
+converter = aml.Converter(aml_jinja.JinjaShortcuts)
+jinja_template_text = converter.convert_text(aml_template_text)
 
-Alternatively, aml.py can be invoked from the command line to perform
-the conversion, as follows:
+aml_jinja and aml_erb provide ready-made converters; their convert_text
+functions may be used directly.
 
-python aml.py [-o output] [input]
+Alternatively, aml_jinja.py and aml_erb.py can be invoked from the command
+line to perform the conversion, as follows:
+
+python aml_jinja.py [-o output] [input]
 
 If input is not specified or is - (dash), standard input is read.
 If output is not specified or is -, processed text is written to
@@ -17,24 +22,29 @@ standard output.
 
 Aml depends on other modules as follows:
 
-shpaml does most of the work. It is patched at runtime so arbitrary
-versions of it are unlikely to work.
+shpaml does most of the work. Aml supplies its own block and line
+conversion functions to it, so arbitrary versions of shpaml are unlikely
+to work.
 
-runtime provides functions for hooking into modules, used to inject
-code into shpaml at runtime.
+whitespace_removal renders shpaml output with whitespace removed.
 
 filter provides command line argument handling. It is only used when
-aml.py is invoked from command line.
+aml is invoked from command line.
 
 '''
 
+import os.path
 import re
+import sys
+import array
+import struct
+import time
 
-# Aml works with unmodified shpaml but certain versions may be required
-# depending on shortcuts used since aml patches shpaml's code at runtime.
-# A version of shpaml that is known to work is bundled with aml.
+# Aml relies on internals of shpaml, so arbitrary versions of it are
+# unlikely to work. A version of shpaml that is known to work is bundled
+# with aml.
 import shpaml
-import runtime
+import whitespace_removal
 
 class IndentError(ValueError):
     ''' Raised when text given to aml uses tabs for indentation.
@@ -47,105 +57,1330 @@ class NotConfiguredError(ValueError):
     ''' Raised when attempting to convert text with aml without first
     choosing template engine and whitespace removal options.'''
 
-class AlreadyConfiguredError(ValueError):
-    ''' Raised when attempting to configure aml more than once per process.
+class Converter(object):
+    ''' Converts aml templates for one template engine.
+    
+    template_engine is a shortcuts class such as aml_jinja.JinjaShortcuts
+    or aml_erb.ErbShortcuts. remove_whitespace selects whitespace removal,
+    see whitespace_removal for details.
+    
+    A converter holds no state between conversions. Any number of
+    converters, for different engines or whitespace options, may be used
+    in one process and from several threads at once.
     
-    Since aml runtime-patches shpaml, a single process may have only one
-    aml configuration.
+    cache, if given, is a ConversionCache that convert_text consults
+    before converting. It may be set or replaced later through the
+    cache attribute, and may be shared between converters.
+    
+    block_cache, if given, is a BlockCache keeping the conversion of
+    blocks, so that blocks already converted in this or other templates
+    are not converted again. It may likewise be set later through the
+    block_cache attribute, and may be shared between converters.
+    Conversions collecting statistics do not use it.
+    
+    stats, if given, is a ConversionStats collecting where conversions
+    spend their time; see collect_stats.
     '''
+    
+    def __init__(self, template_engine, remove_whitespace=True, cache=None,
+            block_cache=None, stats=None):
+        self.template_engine = template_engine
+        self.remove_whitespace = remove_whitespace
+        self.cache = cache
+        self.block_cache = block_cache
+        self.stats = stats
+        self.line_classifier = shpaml.LineClassifier(
+            list(template_engine.LINE_METHODS) + shpaml.LINE_METHODS)
+        self.convert_line = self.line_classifier.convert_line
+        self.html_block_tag = template_engine.html_block_tag
+        if remove_whitespace:
+            self.finish_output = whitespace_removal.render_without_whitespace
+        else:
+            self.finish_output = shpaml.finish_output
+    
+    def convert_text(self, text):
+        ''' Converts text to html. Text must be in aml template format (at).
+        
+        Aml templates are mostly comprised of shpaml syntax with shortcuts
+        added for the template engine. Please refer to the template engine's
+        shortcuts class for syntax details.
+        
+        Indentation in aml is significant, and only spaces are allowed for
+        indentation. If tabs are found in text at the beginning of any lines,
+        IndentError will be raised.
+        
+        Blocks may be nested up to shpaml.MAX_NESTING_DEPTH levels deep;
+        deeper nesting raises shpaml.NestingError.
+        '''
+        
+        cache = self.cache
+        if cache is not None:
+            key = cache.key(text, self.template_engine, self.remove_whitespace)
+            converted = cache.get(key)
+            if converted is None:
+                converted = self.convert_text_uncached(text)
+                cache.put(key, converted)
+            return converted
+        return self.convert_text_uncached(text)
+    
+    def convert_text_uncached(self, text):
+        if self.stats is not None:
+            return self.convert_text_instrumented(text)
+        engine = self.template_engine
+        text = engine.convert_text_pre(text)
+        text = shpaml.indent(text,
+            branch_method=self.html_block_tag,
+            leaf_method=self.convert_line,
+            pass_syntax=shpaml.PASS_SYNTAX,
+            flush_left_syntax=shpaml.FLUSH_LEFT_SYNTAX,
+            flush_left_empty_line=shpaml.FLUSH_LEFT_EMPTY_LINE,
+            indentation_method=shpaml.find_indentation,
+            finish_method=self.finish_output,
+            memo=self.block_memo())
+        text = engine.convert_text_post(text, self.remove_whitespace)
+        return text
+    
+    def block_memo(self):
+        # The block cache as shpaml sees it, holding blocks converted with
+        # this converter's configuration, or None.
+        if self.block_cache is None:
+            return None
+        return self.block_cache.view(self.template_engine, self.remove_whitespace)
+    
+    def configuration_key(self):
+        ''' Returns a string identifying this converter's code and options.
+        
+        Caches of converted text kept outside the process, such as
+        filter.DiskCache, use it to tell whether text converted earlier,
+        possibly by another version of aml, is still valid.
+        '''
+        
+        engine = self.template_engine
+        paths = [shpaml.__file__, whitespace_removal.__file__, __file__,
+            sys.modules[engine.__module__].__file__]
+        return '%s %s.%s %d' % (source_fingerprint(paths),
+            engine.__module__, engine.__name__, bool(self.remove_whitespace))
+    
+    def convert_stream(self, chunks):
+        ''' Converts aml text read incrementally from chunks, yielding
+        converted text as soon as each top-level block is complete.
+        
+        chunks is an iterable of strings, for example an open file, and does
+        not need to be split on line boundaries. Joining everything yielded
+        gives the same text convert_text would return, but memory use is
+        bounded by the largest top-level block rather than by the whole text.
+        Both expand shortcuts one line at a time, see convert_text_pre.
+        
+        IndentError is raised when the first line indented with tabs is
+        read, after output for the preceding blocks has been yielded.
+        '''
+        
+        if self.stats is not None:
+            return self.convert_stream_instrumented(chunks)
+        engine = self.template_engine
+        lines = engine.convert_stream_pre(chunks)
+        blocks = shpaml.indent_stream(lines,
+            branch_method=self.html_block_tag,
+            leaf_method=self.convert_line,
+            pass_syntax=shpaml.PASS_SYNTAX,
+            flush_left_syntax=shpaml.FLUSH_LEFT_SYNTAX,
+            flush_left_empty_line=shpaml.FLUSH_LEFT_EMPTY_LINE,
+            indentation_method=shpaml.find_indentation,
+            finish_method=self.finish_output,
+            memo=self.block_memo())
+        texts = join_output_lines(blocks)
+        return engine.convert_stream_post(texts, self.remove_whitespace)
+    
+    def convert_parallel(self, text, processes=None):
+        ''' Converts text like convert_text, in a pool of processes.
+        
+        Text is split into parts made of whole top-level blocks, which
+        are converted in processes (one per CPU unless processes is
+        given) and joined again. Template statements continued by a
+        sibling in the next part, such as an if followed by an else, and
+        lines joined by whitespace removal across parts come out as they
+        do from convert_text.
+        
+        This only pays off for very large templates. Conversion happens
+        in this process if there is only one process or one part, and
+        with statistics collected.
+        '''
+        
+        cache = self.cache
+        if cache is not None:
+            key = cache.key(text, self.template_engine, self.remove_whitespace)
+            converted = cache.get(key)
+            if converted is None:
+                converted = self.convert_parallel_uncached(text, processes)
+                cache.put(key, converted)
+            return converted
+        return self.convert_parallel_uncached(text, processes)
+    
+    def convert_parallel_uncached(self, text, processes):
+        if processes is None:
+            try:
+                import multiprocessing
+                processes = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                processes = 1
+        if processes <= 1 or self.stats is not None:
+            return self.convert_text_uncached(text)
+        parts = split_top_level(text, processes * PARTS_PER_PROCESS)
+        if len(parts) <= 1:
+            return self.convert_text_uncached(text)
+        # each part with the number of lines before it, for errors
+        offset = 0
+        for index, (part, following) in enumerate(parts):
+            parts[index] = (part, following, offset)
+            offset += part.count('\n')
+        
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(parts)),
+            set_parallel_converter, (self.template_engine, self.remove_whitespace))
+        try:
+            results = pool.map(convert_parallel_part, parts, 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return self.join_parts(results)
+    
+    def join_parts(self, results):
+        # Joins what convert_part returned for the parts of a text.
+        start_tag, end_tag = shpaml.OUTPUT_START_TAG, shpaml.OUTPUT_END_TAG
+        pieces = []
+        last = None
+        for converted, first_kind, last_kind in results:
+            if converted is None:
+                continue
+            # whitespace removal joins a start tag with the line after
+            # it and end tags with the line before them
+            if pieces and not (self.remove_whitespace
+                    and (last == start_tag or first_kind == end_tag)):
+                pieces.append('\n')
+            pieces.append(converted)
+            last = last_kind
+        pieces.append('\n')
+        return self.template_engine.convert_text_post(''.join(pieces),
+            self.remove_whitespace)
+    
+    def convert_part(self, text, following, offset=0):
+        ''' Converts part of a template for convert_parallel. following
+        is the first line of the next part, or None, and offset is the
+        number of lines of the template before the part.
+        
+        Returns the converted lines joined with newlines, or None if
+        there are none, together with the kinds (shpaml.OUTPUT_ kinds) of
+        the first and last output records, which decide how the part is
+        joined with its neighbours.
+        '''
+        
+        engine = self.template_engine
+        text = engine.convert_text_pre(text)
+        prefix_lines = list(map(shpaml.find_indentation, text.rstrip().split('\n')))
+        stop = len(prefix_lines)
+        if following is not None:
+            prefix_lines.append(shpaml.find_indentation(
+                engine.convert_text_pre(following)))
+        records = []
+        shpaml.convert_prefix_lines(prefix_lines, records,
+            self.html_block_tag, self.convert_line, shpaml.PASS_SYNTAX,
+            shpaml.FLUSH_LEFT_SYNTAX, shpaml.FLUSH_LEFT_EMPTY_LINE,
+            shpaml.get_indented_block, stop, self.block_memo(), offset=offset)
+        if not records:
+            return None, None, None
+        return ('\n'.join(self.finish_output(records)), records[0][0],
+            records[-1][0])
+    
+    def render(self, tree):
+        ''' Converts a ParseTree made by parse_text or ParseTree.loads.
+        
+        The result is the text convert_stream gives for the text the tree
+        was parsed from. Parsing is not repeated, so one tree may be
+        rendered by converters for any template engine and whitespace
+        removal option.
+        '''
+        
+        engine = self.template_engine
+        output = []
+        shpaml.convert_prefix_lines(tree.prefix_lines(engine), output,
+            self.html_block_tag, self.convert_line, shpaml.PASS_SYNTAX,
+            shpaml.FLUSH_LEFT_SYNTAX, shpaml.FLUSH_LEFT_EMPTY_LINE,
+            shpaml.get_indented_block, memo=self.block_memo(), ends=tree.ends)
+        text = '\n'.join(self.finish_output(output)) + '\n'
+        return engine.convert_text_post(text, self.remove_whitespace)
+    
+    def collect_stats(self):
+        ''' Makes conversions record statistics in a ConversionStats,
+        created unless the converter has one, and returns it.
+        
+        Conversions with statistics are somewhat slower; without them
+        they cost nothing.
+        '''
+        
+        if self.stats is None:
+            self.stats = ConversionStats()
+        return self.stats
+    
+    def instruments(self, record):
+        # Returns the functions shpaml calls, wrapped to count and time
+        # their work in record.
+        html_block_tag = self.html_block_tag
+        def branch_method(output, block, recurse):
+            record.blocks += 1
+            start = stats_timer()
+            html_block_tag(output, block, recurse)
+            record.block_seconds += stats_timer() - start
+        convert_line = self.line_classifier.counting_convert_line(record.line_methods)
+        def leaf_method(line):
+            record.leaves += 1
+            return convert_line(line)
+        def indentation_method(line):
+            record.lines += 1
+            return shpaml.find_indentation(line)
+        finish_output = self.finish_output
+        if self.remove_whitespace:
+            finish_stage = 'whitespace_removal'
+        else:
+            finish_stage = 'finish_output'
+        def finish_method(output):
+            start = stats_timer()
+            lines = finish_output(output)
+            record.add_time(finish_stage, stats_timer() - start)
+            return lines
+        return branch_method, leaf_method, indentation_method, finish_method
+    
+    def convert_text_instrumented(self, text):
+        engine = self.template_engine
+        record = ConversionStats()
+        record.conversions = 1
+        record.translation_counter(engine)(text.split('\n'))
+        branch_method, leaf_method, indentation_method, finish_method = \
+            self.instruments(record)
+        
+        start = stats_timer()
+        text = engine.convert_text_pre(text)
+        pre_processed = stats_timer()
+        text = shpaml.indent(text,
+            branch_method=branch_method,
+            leaf_method=leaf_method,
+            pass_syntax=shpaml.PASS_SYNTAX,
+            flush_left_syntax=shpaml.FLUSH_LEFT_SYNTAX,
+            flush_left_empty_line=shpaml.FLUSH_LEFT_EMPTY_LINE,
+            indentation_method=indentation_method,
+            finish_method=finish_method)
+        converted = stats_timer()
+        text = engine.convert_text_post(text, self.remove_whitespace)
+        end = stats_timer()
+        
+        record.add_time('convert_text_pre', pre_processed - start)
+        record.add_time('shpaml', converted - pre_processed
+            - sum(record.stages.values()))
+        record.add_time('convert_text_post', end - converted)
+        self.stats.add(record)
+        return text
+    
+    def convert_stream_instrumented(self, chunks):
+        # Stages run interleaved, so each stage is timed together with
+        # the stages it pulls from and those are subtracted afterwards.
+        engine = self.template_engine
+        record = ConversionStats()
+        record.conversions = 1
+        times = {'count': 0.0, 'pre': 0.0, 'shpaml': 0.0, 'total': 0.0}
+        branch_method, leaf_method, indentation_method, finish_method = \
+            self.instruments(record)
+        
+        count_translations = record.translation_counter(engine)
+        def counted(chunks):
+            buffer = ''
+            for chunk in chunks:
+                start = stats_timer()
+                lines = (buffer + chunk).split('\n')
+                buffer = lines.pop()
+                count_translations(lines)
+                times['count'] += stats_timer() - start
+                yield chunk
+            start = stats_timer()
+            count_translations([buffer])
+            times['count'] += stats_timer() - start
+        
+        lines = engine.convert_stream_pre(counted(chunks))
+        blocks = shpaml.indent_stream(timed_iterator(lines, times, 'pre'),
+            branch_method=branch_method,
+            leaf_method=leaf_method,
+            pass_syntax=shpaml.PASS_SYNTAX,
+            flush_left_syntax=shpaml.FLUSH_LEFT_SYNTAX,
+            flush_left_empty_line=shpaml.FLUSH_LEFT_EMPTY_LINE,
+            indentation_method=indentation_method,
+            finish_method=finish_method)
+        texts = join_output_lines(timed_iterator(blocks, times, 'shpaml'))
+        texts = engine.convert_stream_post(texts, self.remove_whitespace)
+        try:
+            for text in timed_iterator(texts, times, 'total'):
+                yield text
+        finally:
+            record.add_time('shpaml', times['shpaml'] - times['pre']
+                - sum(record.stages.values()))
+            record.add_time('convert_text_pre', times['pre'] - times['count'])
+            record.add_time('convert_text_post', times['total'] - times['shpaml'])
+            self.stats.add(record)
 
-def configure(template_engine, remove_whitespace=True):
-    if configuration.configured:
-        raise AlreadyConfiguredError
+class ConversionCache(object):
+    ''' Keeps converted text in memory for Converter.convert_text.
+    
+    Entries are keyed by a hash of the text to convert, the template
+    engine and the whitespace removal option, so one cache can serve any
+    number of converters. Once the converted text held exceeds max_bytes,
+    least recently used entries are evicted. With compress set, entries
+    are stored zlib-compressed: more of them fit in max_bytes, at the cost
+    of a decompression on every hit.
     
-    template_engine.install()
-    configuration.active_shortcuts = template_engine
+    Sizes are measured in bytes for compressed entries and in characters
+    otherwise. Text larger than max_bytes is never stored.
     
-    if remove_whitespace:
-        import whitespace_removal
-        whitespace_removal.WhitespaceRemoval.install()
-        configuration.active_shortcuts.POST_TRANSLATORS = \
-            configuration.active_shortcuts.POST_TRANSLATORS_WITHOUT_WHITESPACE
+    hits, misses and evictions count cache lookups and evicted entries;
+    stats returns them together with the current size.
+    '''
+    
+    def __init__(self, max_bytes=16 * 1024 * 1024, compress=False):
+        import threading
+        
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Entries form a circular doubly linked list in order of use,
+        # most recent last: [previous, next, key, value, size].
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
     
-    configuration.configured = True
+    def key(self, text, template_engine, remove_whitespace):
+        import hashlib
+        
+        if isinstance(text, bytes):
+            data = text
+        else:
+            data = text.encode('utf-8')
+        engine = '%s.%s' % (template_engine.__module__, template_engine.__name__)
+        return (hashlib.sha1(data).digest(), engine, bool(remove_whitespace))
+    
+    def get(self, key):
+        ''' Returns converted text stored under key, or None. '''
+        
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            previous, following = entry[0], entry[1]
+            previous[1] = following
+            following[0] = previous
+            self.link_last(entry)
+            value = entry[3]
+        finally:
+            self.lock.release()
+        if self.compress:
+            import zlib
+            data, decode = value
+            value = zlib.decompress(data)
+            if decode:
+                value = value.decode('utf-8')
+        return value
+    
+    def put(self, key, converted):
+        ''' Stores converted text under key, evicting old entries as
+        needed to stay within max_bytes.
+        '''
+        
+        if self.compress:
+            import zlib
+            decode = not isinstance(converted, bytes)
+            if decode:
+                data = converted.encode('utf-8')
+            else:
+                data = converted
+            data = zlib.compress(data)
+            value, size = (data, decode), len(data)
+        else:
+            value, size = converted, len(converted)
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                return
+            entry = [None, None, key, value, size]
+            self.link_last(entry)
+            self.entries[key] = entry
+            self.size += size
+            root = self.root
+            while self.size > self.max_bytes:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.entries[oldest[2]]
+                self.size -= oldest[4]
+                self.evictions += 1
+        finally:
+            self.lock.release()
+    
+    def link_last(self, entry):
+        root = self.root
+        last = root[0]
+        entry[0] = last
+        entry[1] = root
+        last[1] = entry
+        root[0] = entry
+    
+    def clear(self):
+        ''' Removes all entries. Counters are kept. '''
+        
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            root = self.root
+            root[:] = [root, root, None, None, 0]
+            self.size = 0
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': lookups and float(self.hits) / lookups,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'size': self.size,
+        }
 
-def convert_text(text):
-    ''' Converts text to html. Text must be in aml template format (at).
+class BlockCache(ConversionCache):
+    ''' Keeps the output of converted blocks for Converter, so that
+    templates sharing blocks, or converted again after an edit, only
+    have their new or changed blocks converted.
+    
+    Top-level blocks are kept, and with depth greater than 1 blocks
+    nested up to depth levels deep as well. Blocks are keyed by their
+    lines, including indentation, their depth, the line of the block
+    following them (which decides how template statements are closed),
+    the template engine and the whitespace removal option, so one cache
+    can serve any number of converters.
+    
+    Sizes are counted in output lines, before whitespace removal;
+    max_lines is the number of them kept. hits, misses, evictions and
+    stats are as for ConversionCache.
+    '''
+    
+    def __init__(self, max_lines=256 * 1024, depth=1):
+        ConversionCache.__init__(self, max_lines)
+        self.depth = depth
+    
+    def view(self, template_engine, remove_whitespace):
+        # Returns what shpaml is given as memo by converters for
+        # template_engine and remove_whitespace.
+        engine = '%s.%s' % (template_engine.__module__, template_engine.__name__)
+        return BlockCacheView(self, (engine, bool(remove_whitespace)))
+
+class BlockCacheView(object):
+    # A BlockCache holding the blocks of one converter configuration,
+    # whose keys are prefixed with configuration.
+    def __init__(self, cache, configuration):
+        self.cache = cache
+        self.configuration = configuration
+        self.depth = cache.depth
+    
+    def get(self, key):
+        return self.cache.get((self.configuration, key))
+    
+    def put(self, key, records):
+        self.cache.put((self.configuration, key), records)
+
+class ConversionStats(object):
+    ''' Statistics on the conversions of a Converter, see
+    Converter.collect_stats.
+    
+    stages maps the stages of conversion (convert_text_pre, shpaml,
+    whitespace_removal or finish_output, convert_text_post) to the
+    seconds spent in them; block_seconds is the part of shpaml spent in
+    the template engine's html_block_tag. lines, blocks and leaves count
+    the lines converted, the blocks among them and their leaf lines,
+    and line_methods counts the lines each line method converted.
+    
+    translators maps the names of pre translators to the number of
+    lines they match and the seconds spent looking for them. Pre
+    translators are applied together in a single scan, so these are
+    measured separately on the lines of the text to convert.
+    
+    Statistics of any number of conversions are added up, also from
+    several threads at once. stats returns them all as a dict and
+    report as text.
+    '''
+    
+    def __init__(self):
+        import threading
+        
+        self.lock = threading.Lock()
+        self.conversions = 0
+        self.lines = 0
+        self.blocks = 0
+        self.leaves = 0
+        self.block_seconds = 0.0
+        self.stages = {}
+        self.line_methods = {}
+        # name -> [matches, seconds]
+        self.translators = {}
+    
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+    
+    def translation_counter(self, template_engine):
+        # Returns a function counting the pre translators of
+        # template_engine matching lines of text.
+        names = {}
+        for name in dir(template_engine):
+            names[id(getattr(template_engine, name))] = name
+        translators = []
+        for translator in template_engine.PRE_TRANSLATORS:
+            regex, replacement, first = translator
+            name = names.get(id(translator), regex.pattern)
+            counts = self.translators.setdefault(name, [0, 0.0])
+            translators.append((regex.search, first, counts))
+        def count(lines):
+            for line in lines:
+                key = line.lstrip()[:1]
+                for search, first, counts in translators:
+                    if first is None or (key and key in first):
+                        start = stats_timer()
+                        m = search(line)
+                        counts[1] += stats_timer() - start
+                        if m:
+                            counts[0] += 1
+        return count
+    
+    def add(self, other):
+        ''' Adds the statistics of other to these. '''
+        
+        self.lock.acquire()
+        try:
+            self.conversions += other.conversions
+            self.lines += other.lines
+            self.blocks += other.blocks
+            self.leaves += other.leaves
+            self.block_seconds += other.block_seconds
+            for stage, seconds in other.stages.items():
+                self.add_time(stage, seconds)
+            for name, hits in other.line_methods.items():
+                self.line_methods[name] = self.line_methods.get(name, 0) + hits
+            for name, (matches, seconds) in other.translators.items():
+                counts = self.translators.setdefault(name, [0, 0.0])
+                counts[0] += matches
+                counts[1] += seconds
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {
+                'conversions': self.conversions,
+                'lines': self.lines,
+                'blocks': self.blocks,
+                'leaves': self.leaves,
+                'block_seconds': self.block_seconds,
+                'stages': dict(self.stages),
+                'line_methods': dict(self.line_methods),
+                'translators': dict((name, tuple(counts))
+                    for name, counts in self.translators.items()),
+            }
+        finally:
+            self.lock.release()
+    
+    def report(self):
+        stats = self.stats()
+        lines = ['%(conversions)d conversions: %(lines)d lines, %(blocks)d blocks, '
+            '%(leaves)d leaf lines' % stats]
+        lines.append('Stages:')
+        for stage in STAGES:
+            if stage in stats['stages']:
+                lines.append('  %-28s %9.4fs' % (stage, stats['stages'][stage]))
+                if stage == 'shpaml':
+                    lines.append('    %-26s %9.4fs' % ('html_block_tag', stats['block_seconds']))
+        lines.append('Pre translators (lines matched, seconds searching):')
+        for name, (matches, seconds) in sorted(stats['translators'].items()):
+            lines.append('  %-28s %9d %9.4fs' % (name, matches, seconds))
+        lines.append('Line methods (lines converted):')
+        for name, hits in sorted(stats['line_methods'].items(), key=lambda item: -item[1]):
+            lines.append('  %-28s %9d' % (name, hits))
+        return '\n'.join(lines) + '\n'
+
+class ParseTree(object):
+    ''' The indentation structure of an aml template, see parse_text.
+    
+    Lines are numbered from 0, continued lines counting as one line.
+    kinds holds the kind of each line (one of the LINE_ constants),
+    widths its indentation and texts the rest of it, trailing whitespace
+    included as shortcut expansions may keep it. The lines up to ends[i]
+    are nested in the block of line i; ends of blank lines are unused.
+    
+    kinds is a bytearray and widths and ends are arrays of integers, so
+    trees of large templates stay small. dumps serializes a tree to bytes
+    that loads reads back, for example to keep parsed templates on disk.
+    '''
     
-    Aml templates are mostly comprised of shpaml syntax with shortcuts
-    added for jinja. Please refer to install_jinja_shortcuts for syntax
-    details.
+    def __init__(self, kinds, widths, texts, ends):
+        self.kinds = kinds
+        self.widths = widths
+        self.texts = texts
+        self.ends = ends
     
-    Whitespace removal is enabled; please refer to install_whitespace_removal
-    for details on what whitespace is removed. Whitespace removal is not
-    necessary to generate valid html from aml templates.
+    def __len__(self):
+        return len(self.kinds)
     
-    Whitespace removal is an experimental feature.
+    def children(self, index=None):
+        ''' Yields the numbers of the lines heading the blocks nested
+        directly in the block of line index, or the top-level blocks if
+        index is None. Blank lines are skipped.
+        '''
+        
+        kinds, ends = self.kinds, self.ends
+        if index is None:
+            i, stop = 0, len(kinds)
+        else:
+            i, stop = index + 1, ends[index]
+        while i < stop:
+            if kinds[i] == LINE_BLANK:
+                i += 1
+            else:
+                yield i
+                i = ends[i]
+    
+    def prefix_lines(self, template_engine):
+        # The (prefix, line) tuples shpaml converts, with the shortcuts of
+        # template_engine expanded.
+        characters = template_engine.shortcut_characters()
+        # lines of every kind are looked at if the engine has shortcuts
+        # parse_text does not know about
+        everywhere = characters is None or \
+            [c for c in characters if c not in SHORTCUT_CHARACTERS]
+        prefixes = {}
+        prefix_lines = []
+        append = prefix_lines.append
+        # shortcut lines are expanded all at once afterwards
+        shortcuts = []
+        for kind, width, text in zip(self.kinds, self.widths, self.texts):
+            if kind == LINE_BLANK:
+                append(('', ''))
+                continue
+            prefix = prefixes.get(width)
+            if prefix is None:
+                prefix = prefixes[width] = ' ' * width
+            if kind == LINE_SHORTCUT or everywhere and (
+                    characters is None or text[:1] in characters):
+                shortcuts.append((len(prefix_lines), prefix))
+                append(prefix + text)
+            else:
+                append((prefix, text.rstrip()))
+        if shortcuts:
+            lines = template_engine.translate_lines(
+                [prefix_lines[i] for i, prefix in shortcuts])
+            split_indentation = shpaml.find_indentation
+            for (i, prefix), line in zip(shortcuts, lines):
+                # expansions normally keep the indentation
+                width = len(prefix)
+                if line.startswith(prefix) and line[width:width + 1].strip():
+                    prefix_lines[i] = (prefix, line[width:].rstrip())
+                else:
+                    prefix_lines[i] = split_indentation(line)
+        return prefix_lines
+    
+    def dumps(self):
+        ''' Returns the tree serialized to bytes. '''
+        
+        text = '\n'.join(self.texts)
+        if isinstance(text, bytes):
+            flags = 0
+        else:
+            flags = TREE_UNICODE
+            text = text.encode('utf-8')
+        return EMPTY_BYTES.join([
+            struct.pack(TREE_HEADER, TREE_MAGIC, TREE_VERSION, flags, len(self.kinds)),
+            bytes(self.kinds),
+            array_bytes(self.widths),
+            array_bytes(self.ends),
+            text,
+        ])
+    
+    @classmethod
+    def loads(cls, data):
+        ''' Reads a tree serialized by dumps. ValueError is raised if data
+        is not one, or was serialized by an incompatible version of aml.
+        '''
+        
+        header = struct.calcsize(TREE_HEADER)
+        if len(data) < header:
+            raise ValueError('Data is not a serialized parse tree')
+        magic, version, flags, count = struct.unpack(TREE_HEADER, data[:header])
+        if magic != TREE_MAGIC:
+            raise ValueError('Data is not a serialized parse tree')
+        if version != TREE_VERSION:
+            raise ValueError('Parse tree format %d is not supported' % version)
+        size = UINT32_SIZE * count
+        if len(data) < header + count + 2 * size:
+            raise ValueError('Serialized parse tree is truncated')
+        offset = header + count
+        kinds = bytearray(data[header:offset])
+        widths = bytes_array(data[offset:offset + size])
+        ends = bytes_array(data[offset + size:offset + 2 * size])
+        text = data[offset + 2 * size:]
+        if flags & TREE_UNICODE:
+            texts = text.decode('utf-8').split('\n')
+        else:
+            texts = text.split(NEWLINE_BYTES)
+        if len(texts) != count:
+            raise ValueError('Serialized parse tree is truncated')
+        return cls(kinds, widths, texts, ends)
+
+def configure(template_engine, remove_whitespace=True, cache=None,
+        block_cache=None):
+    ''' Sets up the converter used by convert_text and convert_stream.
+    
+    Calling configure again replaces it. Programs that need more than
+    one configuration at a time should create Converter objects instead.
+    '''
     
-    Indentation in aml is significant, and only spaces are allowed for
-    indentation. If tabs are found in text at the beginning of any lines,
-    IndentError will be raised.
+    configuration.converter = Converter(template_engine, remove_whitespace, cache,
+        block_cache)
+
+def configure_default(converter):
+    ''' Makes converter the one convert_text and convert_stream use,
+    unless configure was called before. aml_jinja and aml_erb call this
+    with their converters when imported, so that importing one of them
+    is enough to use aml.convert_text.
+    '''
+    
+    if configuration.converter is None:
+        configuration.converter = converter
+
+def convert_text(text):
+    ''' Converts text with the converter set up by configure.
+    See Converter.convert_text for details.
+    '''
+    
+    if configuration.converter is None:
+        raise NotConfiguredError
+    
+    return configuration.converter.convert_text(text)
+
+def convert_stream(chunks):
+    ''' Converts chunks with the converter set up by configure.
+    See Converter.convert_stream for details.
     '''
     
-    if not configuration.configured:
+    if configuration.converter is None:
         raise NotConfiguredError
     
-    text = configuration.active_shortcuts.convert_text_pre(text)
-    text = shpaml.convert_text(text)
-    text = configuration.active_shortcuts.convert_text_post(text)
-    return text
+    return configuration.converter.convert_stream(chunks)
+
+def parse_text(text):
+    ''' Parses aml text into a ParseTree, which Converter.render converts
+    without parsing the text again.
+    
+    The tree records the nesting of lines and their kind, but expands no
+    shortcuts, so it does not depend on template engine. As for
+    convert_text, IndentError is raised if tabs are used for indentation.
+    '''
+    
+    lines = list(read_lines((text,)))
+    count = len(lines)
+    # trailing blank lines are dropped, as conversion drops them
+    while count > 1 and not lines[count - 1].strip():
+        count -= 1
+    split_indentation = shpaml.find_indentation
+    kinds = bytearray(count)
+    widths = array.array(UINT32, [0]) * count
+    texts = []
+    prefix_lines = []
+    for i in range(count):
+        line = lines[i]
+        prefix, stripped = split_indentation(line)
+        prefix_lines.append((prefix, stripped))
+        if stripped:
+            width = len(prefix)
+            kinds[i] = line_kind(stripped)
+            widths[i] = width
+            texts.append(line[width:])
+        else:
+            texts.append(stripped)
+    ends = array.array(UINT32, shpaml.find_block_ends(prefix_lines))
+    return ParseTree(kinds, widths, texts, ends)
 
 # Only implementation is beyond this point.
 
+def source_fingerprint(paths):
+    # Hashes the source files of modules, given as their __file__, along
+    # with the Python version. Paths of modules bundled into one file
+    # are the same and are hashed once.
+    import hashlib
+    
+    digest = hashlib.sha1(('%d.%d' % sys.version_info[:2]).encode('ascii'))
+    seen = {}
+    for path in paths:
+        if path[-4:] in ('.pyc', '.pyo') and os.path.exists(path[:-1]):
+            path = path[:-1]
+        path = os.path.abspath(path)
+        if path in seen:
+            continue
+        seen[path] = True
+        f = open(path, 'rb')
+        try:
+            digest.update(f.read())
+        finally:
+            f.close()
+    return digest.hexdigest()
+
+stats_timer = getattr(time, 'perf_counter', time.time)
+
+STAGES = ('convert_text_pre', 'shpaml', 'whitespace_removal',
+    'finish_output', 'convert_text_post')
+
+def timed_iterator(iterable, times, stage):
+    # Yields the items of iterable, adding the time taken to produce
+    # them to times[stage].
+    iterator = iter(iterable)
+    while True:
+        start = stats_timer()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            times[stage] += stats_timer() - start
+            return
+        times[stage] += stats_timer() - start
+        yield item
+
+# Kinds of lines in a ParseTree. Shortcut lines start with one of
+# SHORTCUT_CHARACTERS, which template engines may expand; raw lines are
+# html or template tags, text lines start with '| ' and flush left lines
+# with '||'. Markup lines are tags or text, depending on the line
+# methods of the template engine.
+LINE_BLANK = 0
+LINE_MARKUP = 1
+LINE_SHORTCUT = 2
+LINE_RAW = 3
+LINE_TEXT = 4
+LINE_FLUSH_LEFT = 5
+LINE_PASS = 6
+LINE_COMMENT = 7
+
+# shortcuts of aml_jinja and aml_erb start with these
+SHORTCUT_CHARACTERS = '%=>~!'
+
+def line_kind(line):
+    # The kind of a non-blank line without its indentation.
+    first = line[0]
+    if first in SHORTCUT_CHARACTERS:
+        return LINE_SHORTCUT
+    if first == '|':
+        if line.startswith(shpaml.FLUSH_LEFT_EMPTY_LINE):
+            return LINE_FLUSH_LEFT
+        if shpaml.TEXT.regex.match(line):
+            return LINE_TEXT
+    elif shpaml.RAW_HTML.regex.match(line):
+        return LINE_RAW
+    elif line == shpaml.PASS_SYNTAX:
+        return LINE_PASS
+    elif shpaml.COMMENT_SYNTAX.match(line):
+        return LINE_COMMENT
+    return LINE_MARKUP
+
+# Serialized parse trees start with a header, followed by the kinds of
+# lines as bytes, their widths and ends as little-endian 32-bit integers
+# and their texts joined with newlines, encoded in UTF-8 if TREE_UNICODE
+# is set.
+TREE_HEADER = '<4sBBI'
+TREE_MAGIC = 'AMLT'.encode('ascii')
+TREE_VERSION = 1
+TREE_UNICODE = 1
+
+# str under Python 2, bytes under Python 3, without bytes literals
+# that Python 2.5 and earlier do not accept.
+EMPTY_BYTES = ''.encode('ascii')
+NEWLINE_BYTES = '\n'.encode('ascii')
+
+UINT32 = [code for code in 'IL' if array.array(code).itemsize == 4][0]
+UINT32_SIZE = 4
+
+def array_bytes(integers):
+    if sys.byteorder == 'big':
+        integers = array.array(UINT32, integers)
+        integers.byteswap()
+    if hasattr(integers, 'tobytes'):
+        return integers.tobytes()
+    return integers.tostring()
+
+def bytes_array(data):
+    integers = array.array(UINT32)
+    if hasattr(integers, 'frombytes'):
+        integers.frombytes(data)
+    else:
+        integers.fromstring(data)
+    if sys.byteorder == 'big':
+        integers.byteswap()
+    return integers
+
+# convert_parallel splits text into this many parts per process, so that
+# processes finishing early take over parts of the others.
+PARTS_PER_PROCESS = 4
+
+TOP_LEVEL_LINE = shpaml.LazyRegex(r'\n(?=\S)')
+
+def split_top_level(text, count):
+    ''' Splits text into about count parts of similar size, each made of
+    whole top-level blocks, for Converter.convert_parallel.
+    
+    Returns a list of (part, following) pairs, where following is the
+    first line of the next part, or None for the last part. Blank lines
+    go with the block after them. Parts do not start at PASS or comment
+    lines, which belong with the block before them, nor next to lines
+    that join the following line: continued lines and lines of a lone
+    shortcut character, which expand together with the next line.
+    '''
+    
+    length = len(text)
+    size = length // count
+    parts = []
+    start = 0
+    position = size
+    while len(parts) < count - 1:
+        m = TOP_LEVEL_LINE.search(text, position)
+        if m is None:
+            break
+        line_start = m.end()
+        line_end = text.find('\n', line_start)
+        if line_end < 0:
+            line_end = length
+        position = line_end
+        line = text[line_start:line_end].rstrip()
+        # the end of the last non-blank line before this one
+        end = m.start()
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if end <= start or text[line_end - 1] == '\\' or len(line) == 1 \
+                or line == shpaml.PASS_SYNTAX or shpaml.COMMENT_SYNTAX.match(line):
+            continue
+        if text[end - 1] == '\\' and text[end] == '\n':
+            continue
+        if len(text[text.rfind('\n', 0, end) + 1:end].strip()) == 1:
+            continue
+        split = text.find('\n', end) + 1
+        parts.append((text[start:split], text[line_start:line_end]))
+        start = split
+        position = start + size
+    parts.append((text[start:], None))
+    return parts
+
+parallel_converter = None
+
+def set_parallel_converter(template_engine, remove_whitespace):
+    # Sets up the converter of a convert_parallel worker process.
+    global parallel_converter
+    parallel_converter = Converter(template_engine, remove_whitespace)
+
+def convert_parallel_part(part):
+    return parallel_converter.convert_part(*part)
+
 class Configuration:
     def __init__(self):
-        self.configured = False
-        self.active_shortcuts = None
+        self.converter = None
 
 configuration = Configuration()
 
-TAB_INDENT = re.compile(r'^ *\t', re.M)
-LINE_CONTINUATION = re.compile(r'\\$\n\s*', re.M)
+TAB_INDENT = shpaml.LazyRegex(r'^ *\t', re.M)
+LINE_CONTINUATION = shpaml.LazyRegex(r'\\$\n\s*', re.M)
+CONTINUATION_WHITESPACE = ' \t\r\f\v'
 
-def fixup(regex, flags, replacement):
-    if flags is not None:
-        options = [flags]
-    else:
-        options = []
-    regex = re.compile(regex, *options)
-    return (regex, replacement)
+def read_lines(chunks):
+    ''' Splits an iterable of text chunks into lines, checking
+    indentation and joining continued lines on the way.
+    
+    A backslash at the end of a line joins the following line to it,
+    without the following line's leading whitespace.
+    '''
+    
+    def physical_lines():
+        buffer = ''
+        for chunk in chunks:
+            lines = (buffer + chunk).split('\n')
+            buffer = lines.pop()
+            for line in lines:
+                yield line, True
+        yield buffer, False
+    
+    joined = None
+    for line, newline in physical_lines():
+        if TAB_INDENT.match(line):
+            raise IndentError('Text uses tabs for indentation')
+        if joined is not None:
+            # a continuation swallows whitespace up to the next text
+            line = line.lstrip(CONTINUATION_WHITESPACE)
+            if not line and newline:
+                continue
+            line = joined + line
+            joined = None
+        if newline and line.endswith('\\'):
+            joined = line[:-1]
+            continue
+        yield line
+    if joined is not None:
+        yield joined
+
+def join_output_lines(blocks):
+    empty = True
+    for lines in blocks:
+        if lines:
+            empty = False
+            yield '\n'.join(lines) + '\n'
+    # shpaml ends its output with a newline even if there are no lines
+    if empty:
+        yield '\n'
+
+def fixup(regex, flags, replacement, first=None):
+    # first lists the characters that lines matched by a pre translator
+    # start with, after indentation. Pre translators without it are
+    # tried on every line.
+    regex = shpaml.LazyRegex(regex, flags or 0)
+    return (regex, replacement, first)
+
+GROUP_REFERENCE = shpaml.LazyRegex(r'\\(?:(\d+)|g<(\d+)>)')
+
+def pre_scan(translators):
+    ''' Fuses translators into a single regex so that convert_text_pre
+    can find tab indentation and expand every shortcut in one scan of the
+    text, instead of one scan per translator.
+    
+    Like convert_stream_pre, the scan expands shortcuts one line at a
+    time: a line consisting of nothing but a shortcut character expands
+    on its own rather than swallowing the following line. Matches that
+    would span lines make the scan give up (see expand_shortcut), and
+    lines are then translated one at a time instead.
+    
+    Returns a PreScan, which fuses translators when first used, so that
+    defining a template engine compiles no regex. Its get method returns
+    (regex, expansions), where expansions maps the index of the group
+    wrapping each translator to a (format, groups) pair producing its
+    replacement, or None if translators cannot be fused: they lack the
+    characters lines they match start with, use flags other than re.M,
+    refer to groups in their patterns or use replacement escapes other
+    than group references.
+    '''
+    
+    return PreScan(translators)
+
+class PreScan(object):
+    def __init__(self, translators):
+        self.translators = translators
+        self.fused = None
+    
+    def get(self):
+        if self.fused is None:
+            # a list, so that translators that cannot be fused are
+            # only tried once
+            self.fused = [fuse_translators(self.translators)]
+        return self.fused[0]
+
+def fuse_translators(translators):
+    # Builds what PreScan.get returns.
+    patterns = [r'(^ *\t)']
+    characters = '\t'
+    expansions = {}
+    offset = 2
+    multiline = re.compile('', re.M).flags
+    for regex, replacement, first in translators:
+        if first is None or regex.flags != multiline:
+            return None
+        if re.search(r'\\\d|\(\?P=', regex.pattern):
+            return None
+        format = []
+        groups = []
+        position = 0
+        for m in GROUP_REFERENCE.finditer(replacement):
+            format.append(replacement[position:m.start()].replace('%', '%%'))
+            format.append('%s')
+            groups.append(offset + int(m.group(1) or m.group(2)))
+            position = m.end()
+        format.append(replacement[position:].replace('%', '%%'))
+        format = ''.join(format)
+        if '\\' in format:
+            return None
+        expansions[offset] = (format, tuple(groups))
+        patterns.append('(%s)' % regex.pattern)
+        characters += first
+        offset += regex.groups + 1
+    # the lookahead lets the scan skip other lines quickly
+    pattern = r'^(?=[^\S\n]*[%s])(?:%s)' % (
+        re.escape(characters), '|'.join(patterns))
+    return (re.compile(pattern, re.M), expansions)
+
+class MultilineShortcut(Exception):
+    # Raised by expand_shortcut for a match spanning lines, which
+    # translating one line at a time would not expand.
+    pass
+
+def expand_shortcut(expansions):
+    # Returns the replacement function for the regex pre_scan returns
+    # with expansions.
+    def expand(m):
+        index = m.lastindex
+        if index == 1:
+            raise IndentError('Text uses tabs for indentation')
+        if '\n' in m.group():
+            raise MultilineShortcut()
+        format, groups = expansions[index]
+        if not groups:
+            return format
+        if len(groups) == 1:
+            return format % m.group(groups[0])
+        return format % m.group(*groups)
+    return expand
 
 class ShortcutsBase:
-    active_post_translators = None
+    # Line methods (see shpaml.syntax) taking priority over shpaml's own.
+    LINE_METHODS = []
+    
+    # Built with pre_scan from PRE_TRANSLATORS, if they allow it.
+    PRE_SCAN = None
+    
+    @classmethod
+    def translate_line(cls, line):
+        # Applies pre translators to one line, skipping those that do
+        # not handle the character the line starts with.
+        key = line.lstrip()[:1]
+        for regex, replacement, first in cls.PRE_TRANSLATORS:
+            if first is None or (key and key in first):
+                translated = regex.sub(replacement, line)
+                if translated != line:
+                    line = translated
+                    key = line.lstrip()[:1]
+        return line
+    
+    @classmethod
+    def translate_lines(cls, lines):
+        # Applies pre translators to each of lines. The lines are joined
+        # and expanded in one PRE_SCAN pass unless a shortcut extends over
+        # the following line, which would change the number of lines.
+        fused = cls.fused_pre_translators()
+        if fused is not None:
+            scan, expansions = fused
+            try:
+                translated = scan.sub(expand_shortcut(expansions),
+                    '\n'.join(lines)).split('\n')
+            except MultilineShortcut:
+                translated = None
+            if translated is not None and len(translated) == len(lines):
+                return translated
+        return [cls.translate_line(line) for line in lines]
+    
+    @classmethod
+    def fused_pre_translators(cls):
+        # PRE_SCAN's (regex, expansions), or None.
+        if cls.PRE_SCAN is None:
+            return None
+        return cls.PRE_SCAN.get()
+    
+    @classmethod
+    def shortcut_characters(cls):
+        # The characters lines expanded by pre translators start with,
+        # or None if pre translators may expand any line.
+        characters = ''
+        for regex, replacement, first in cls.PRE_TRANSLATORS:
+            if first is None:
+                return None
+            for character in first:
+                if character not in characters:
+                    characters += character
+        return characters
+    
+    @classmethod
+    def html_block_tag(cls, output, block, recurse):
+        ''' Converts a block. Template engines override this to close
+        their template statements; block.next_sibling() gives the block
+        after it, for statements whose closing depends on what comes next.
+        '''
+        
+        shpaml.html_block_tag(output, block, recurse)
     
     @classmethod
     def convert_text_pre(cls, text):
         ''' Performs pre-processing pass on text before handing it off to shpaml.
         
-        First, indentation is checked and if tabs are used for indentation
-        IndentError is raised.
+        Continued lines are joined first. Then a single PRE_SCAN pass
+        raises IndentError if tabs are used for indentation and replaces
+        template engine shortcuts with expanded equivalents.
         
-        Then, jinja shortcuts in text are replaced with expanded equivalents.
+        Shortcuts are expanded one line at a time, as by convert_stream_pre,
+        so a line consisting of nothing but a shortcut character (such as
+        '= ') expands on its own; earlier versions let such a line swallow
+        the following line.
         '''
         
-        if TAB_INDENT.search(text):
-            raise IndentError('Text uses tabs for indentation')
+        fused = cls.fused_pre_translators()
+        if fused is None:
+            return '\n'.join(cls.convert_stream_pre((text,)))
+        scan, expansions = fused
+        
+        if '\\\n' in text:
+            if TAB_INDENT.search(text):
+                raise IndentError('Text uses tabs for indentation')
+            text = LINE_CONTINUATION.sub('', text)
         
-        text = LINE_CONTINUATION.sub('', text)
+        try:
+            return scan.sub(expand_shortcut(expansions), text)
+        except MultilineShortcut:
+            return '\n'.join(cls.convert_stream_pre((text,)))
+    
+    @classmethod
+    def convert_text_post(cls, text, remove_whitespace=False):
+        ''' Performs post-processing pass on text after it is processed by shpaml.
         
-        for translator in cls.PRE_TRANSLATORS:
-            text = translator[0].sub(translator[1], text)
+        Template engines close their statements while blocks are converted
+        (see html_block_tag), so the text is returned unchanged unless an
+        engine overrides this.
+        '''
         
         return text
     
     @classmethod
-    def convert_text_post(cls, text):
-        ''' Performs post-processing pass on text after it is processed by shpaml.
+    def convert_stream_pre(cls, chunks):
+        ''' Streaming counterpart of convert_text_pre. Yields pre-processed
+        lines without line terminators.
         
-        Post-processing fixes up things like if/endif/else/endelse into if/else/endif.'
+        Shortcuts are expanded one line at a time, so a line consisting of
+        nothing but a shortcut character expands on its own rather than
+        swallowing the following line.
         '''
         
-        for translator in cls.POST_TRANSLATORS:
-            text = translator[0].sub(translator[1], text)
+        characters = cls.shortcut_characters()
+        translate_line = cls.translate_line
+        for line in read_lines(chunks):
+            if characters is None:
+                line = translate_line(line)
+            else:
+                key = line.lstrip()[:1]
+                if key and key in characters:
+                    line = translate_line(line)
+            yield line
+    
+    @classmethod
+    def convert_stream_post(cls, texts, remove_whitespace=False):
+        ''' Streaming counterpart of convert_text_post. texts is an iterable
+        of converted top-level blocks, each ending with a newline.
+        '''
         
-        return text
+        for text in texts:
+            yield cls.convert_text_post(text, remove_whitespace)
@@ -1,17 +1,43 @@
 import re
 import shpaml
 import aml
-import runtime
-import whitespace_removal
+
+@shpaml.syntax(r'<% > *((\w+).*)', first='<')
+def SELF_CLOSING_TEMPLATE_STATEMENT(m):
+    return '<%% %s<%% end %%>' % (m.group(1))
 
 class ErbShortcuts(aml.ShortcutsBase):
-    LINE_STATEMENT = aml.fixup(r'^(\s*)%(?!%)(\s*)(.*)$', re.M, r'\1<%\2\3\2%>')
-    LINE_EXPRESSION = aml.fixup(r'^(\s*)=(\s*)(.*)$', re.M, r'\1<%=\2\3\2%>')
-    PREPROCESSED_LINE_STATEMENT = aml.fixup(r'^(\s*)!(?!!)(\s*)(.*)$', re.M, r'\1<%!\2\3\2%>')
-    PREPROCESSED_LINE_EXPRESSION = aml.fixup(r'^(\s*)!(?:[!=])(\s*)(.*)$', re.M, r'\1<%!=\2\3\2%>')
-    SELF_CLOSING_TAG = aml.fixup(r'^(\s*)>(?=\w)', re.M, r'\1> ')
-    END_ELSE = aml.fixup(r'^(\s*)<%(!?)\s*end\s*%>\n(\1<%\2\s*else\s*%>)', re.M, r'\3')
-    END_ELSE_WITHOUT_WHITESPACE = aml.fixup(r'<%(!?)\s*end\s*%>\n(<%\1\s*else\s*%>)', None, r'\2')
+    ''' Shortcuts intended to be used with Embedded Ruby (ERb) templates.
+    
+    Specifically, allows for the following markup in templates:
+    
+    1. Automatic generation of appropriate closing tags for template instructions:
+    
+    % if
+        ...
+    % else
+        ...
+    
+    2. '% stmt' shortcut as a replacement for '<% stmt %>', and corresponding
+       shpaml-style self-closing tag:
+    
+    % for post in @posts
+        ...
+    
+    % >content_for :foo do
+    
+    3. '>tag' is equivalent to '> tag'.
+    
+    4. '= expression' is equivalent to '<%= expression %>'
+    '''
+    
+    LINE_STATEMENT = aml.fixup(r'^(\s*)%(?!%)(\s*)(.*)$', re.M, r'\1<%\2\3\2%>', '%')
+    LINE_EXPRESSION = aml.fixup(r'^(\s*)=(\s*)(.*)$', re.M, r'\1<%=\2\3\2%>', '=')
+    PREPROCESSED_LINE_STATEMENT = aml.fixup(r'^(\s*)!(?!!)(\s*)(.*)$', re.M, r'\1<%!\2\3\2%>', '!')
+    PREPROCESSED_LINE_EXPRESSION = aml.fixup(r'^(\s*)!(?:[!=])(\s*)(.*)$', re.M, r'\1<%!=\2\3\2%>', '!')
+    SELF_CLOSING_TAG = aml.fixup(r'^(\s*)>(?=\w)', re.M, r'\1> ', '>')
+    TEMPLATE_STATEMENT = shpaml.LazyRegex(r'<%(!?)\s*(\w+)')
+    ELSE_STATEMENT = shpaml.LazyRegex(r'<%(!?)\s*else\s*%>')
 
     PRE_TRANSLATORS = [
         LINE_STATEMENT,
@@ -20,68 +46,47 @@ class ErbShortcuts(aml.ShortcutsBase):
         PREPROCESSED_LINE_EXPRESSION,
         SELF_CLOSING_TAG,
     ]
-
-    POST_TRANSLATORS = [
-        END_ELSE,
-    ]
     
-    POST_TRANSLATORS_WITHOUT_WHITESPACE = [
-        END_ELSE_WITHOUT_WHITESPACE,
+    PRE_SCAN = aml.pre_scan(PRE_TRANSLATORS)
+
+    LINE_METHODS = [
+        SELF_CLOSING_TEMPLATE_STATEMENT,
     ]
     
     @classmethod
-    def install(cls):
-        ''' Installs various shortcuts intended to be used with Embedded Ruby (ERb) templates.
-        
-        Specifically, allows for the following markup in templates:
-        
-        1. Automatic generation of appropriate closing tags for template instructions:
-        
-        % if
-            ...
-        % else
-            ...
-        
-        2. '% stmt' shortcut as a replacement for '<% stmt %>', and corresponding
-           shpaml-style self-closing tag:
-        
-        % for post in @posts
-            ...
-        
-        % >content_for :foo do
-        
-        3. '>tag' is equivalent to '> tag'.
-        
-        4. '= expression' is equivalent to '<%= expression %>'
-        '''
-        
-        @shpaml.syntax(r'<% > *((\w+).*)')
-        def SELF_CLOSING_TEMPLATE_STATEMENT(m):
-            tag = m.group(1).strip()
-            return '<%% %s<%% end %%>' % (m.group(1))
-        
-        shpaml.LINE_METHODS.insert(0, SELF_CLOSING_TEMPLATE_STATEMENT)
-        
-        TEMPLATE_STATEMENT = re.compile(r'<%(!?) (\w+)')
-        
-        def html_block_tag_with_template_statement(html_block_tag_without_template_statement, output, block, recurse):
-            append = output.append
-            prefix, tag = block[0]
-            if shpaml.RAW_HTML.regex.match(tag):
-                match = TEMPLATE_STATEMENT.match(tag)
-                if match:
-                    append(prefix + whitespace_removal.TextWithoutWhitespace(tag))
-                    recurse(block[1:])
-                    finalizer = '<%%%s end %%>' % match.group(1)
-                    append(prefix + whitespace_removal.TextWithoutWhitespace(finalizer))
+    def html_block_tag(cls, output, block, recurse):
+        prefix, tag = block[0]
+        if shpaml.RAW_HTML.regex.match(tag):
+            match = cls.TEMPLATE_STATEMENT.match(tag)
+            if match:
+                append = output.append
+                append((shpaml.OUTPUT_LINE, prefix, tag))
+                recurse(block[1:])
+                # an else sibling after the block takes over closing it
+                if cls.continues(block, match.group(1)):
                     return
-            html_block_tag_without_template_statement(output, block, recurse)
-        
-        runtime.hook_module_function(shpaml, 'html_block_tag', html_block_tag_with_template_statement)
+                finalizer = '<%%%s end %%>' % match.group(1)
+                append((shpaml.OUTPUT_LINE, prefix, finalizer))
+                return
+        shpaml.html_block_tag(output, block, recurse)
+    
+    @classmethod
+    def continues(cls, block, bang):
+        # True if the next sibling of block is an else, preprocessed if
+        # the block's statement is.
+        sibling = block.next_sibling()
+        if sibling is None:
+            return False
+        match = cls.ELSE_STATEMENT.match(sibling[1])
+        return match is not None and match.group(1) == bang
 
-aml.configure(ErbShortcuts)
-convert_text = aml.convert_text
+converter = aml.Converter(ErbShortcuts)
+aml.configure_default(converter)
+convert_text = converter.convert_text
+convert_stream = converter.convert_stream
 
 if __name__ == "__main__":
     import filter
-    filter.perform_conversion(convert_text)
+    filter.perform_conversion(convert_stream, stream=True,
+        cache_key=converter.configuration_key, extensions=('.shpaml', ''),
+        stats=converter.collect_stats, parallel=converter.convert_parallel)
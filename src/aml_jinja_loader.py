@@ -0,0 +1,435 @@
+''' Jinja2 loader that converts aml templates when Jinja loads them,
+so that no converted copies need to be generated and kept in sync.
+
+import jinja2
+import aml_jinja_loader
+environment = jinja2.Environment(
+    loader=aml_jinja_loader.AmlLoader('templates'), auto_reload=True)
+template = environment.get_template('index.at')
+
+Templates can also be converted and compiled ahead of time, at build
+time, with precompile:
+
+python aml_jinja_loader.py -o templates.zip templates
+
+Requires Jinja2.
+'''
+
+import os.path
+import re
+import hashlib
+import threading
+import jinja2
+import jinja2.lexer
+import jinja2.parser
+import aml
+import aml_jinja
+
+class AmlLoader(jinja2.FileSystemLoader):
+    ''' Loads templates from the file system like jinja2.FileSystemLoader,
+    converting those whose names end with one of extensions with
+    converter (aml_jinja.converter by default). Other templates are
+    loaded unchanged.
+
+    Converted templates are up to date as long as their file's
+    modification time is unchanged, or failing that its content, so
+    Jinja's template cache and auto_reload work as for plain templates.
+
+    A template is converted once per change: threads loading the same
+    template at once wait for one of them to convert it, and a template
+    Jinja evicted from its cache is not converted again. Converted
+    templates are kept for this in a ConversionCache of about
+    max_converted characters, least recently loaded ones making room.
+
+    With a bytecode cache in the environment, templates are looked up
+    in it by their aml source, so that templates compiled before, for
+    example by precompile, are neither converted nor compiled again.
+
+    With direct, converted templates are parsed with parse_template,
+    which makes most of their tokens without Jinja's lexer. It relies on
+    internals of Jinja's lexer and parser, so direct requires a version
+    of Jinja2 in DIRECT_JINJA_VERSIONS; ValueError is raised otherwise.
+    '''
+
+    # conversions of different files at once wait for each other only
+    # when their names hash to the same lock
+    LOCKS = 64
+
+    def __init__(self, searchpath, encoding='utf-8', followlinks=False,
+            converter=None, extensions=('.at',), direct=False,
+            max_converted=16 * 1024 * 1024):
+        jinja2.FileSystemLoader.__init__(self, searchpath, encoding, followlinks)
+        if converter is None:
+            converter = aml_jinja.converter
+        self.converter = converter
+        self.extensions = tuple(extensions)
+        self.locks = [threading.Lock() for i in range(self.LOCKS)]
+        # (file name, digest of source) -> converted source
+        self.converted = aml.ConversionCache(max_converted)
+        self.configuration_key = None
+        if direct and not supports_direct_parsing():
+            raise ValueError('direct parsing requires Jinja2 %d.%d up to %d.%d, not %s'
+                % (DIRECT_JINJA_VERSIONS[0] + DIRECT_JINJA_VERSIONS[1]
+                + (jinja2.__version__,)))
+        self.direct = direct
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = jinja2.FileSystemLoader.get_source(
+            self, environment, template)
+        if not filename.endswith(self.extensions):
+            return source, filename, uptodate
+        digest = source_digest(source)
+        return (self.convert(filename, source, digest), filename,
+            self.uptodate_function(filename, digest))
+
+    def load(self, environment, name, globals=None):
+        bytecode_cache = environment.bytecode_cache
+        if bytecode_cache is None and not self.direct:
+            return jinja2.FileSystemLoader.load(self, environment, name, globals)
+        if globals is None:
+            globals = {}
+        source, filename, uptodate = jinja2.FileSystemLoader.get_source(
+            self, environment, name)
+        converted = filename.endswith(self.extensions)
+        key = source
+        if converted:
+            # code compiled from other conversions of the same source
+            # must not be used
+            if self.configuration_key is None:
+                self.configuration_key = self.converter.configuration_key()
+            key = u'%s\n%s' % (self.configuration_key, source)
+            digest = source_digest(source)
+            uptodate = self.uptodate_function(filename, digest)
+        code = None
+        if bytecode_cache is not None:
+            bucket = bytecode_cache.get_bucket(environment, name, filename, key)
+            code = bucket.code
+        if code is None:
+            if converted:
+                source = self.convert(filename, source, digest)
+                if self.direct:
+                    source = parse_template(environment, source, name, filename)
+            code = environment.compile(source, name, filename)
+            if bytecode_cache is not None:
+                bucket.code = code
+                bytecode_cache.set_bucket(bucket)
+        return environment.template_class.from_code(environment, code,
+            globals, uptodate)
+
+    def convert(self, filename, source, digest):
+        # Returns source converted, converting it once per change.
+        lock = self.locks[hash(filename) % self.LOCKS]
+        key = (filename, digest)
+        lock.acquire()
+        try:
+            converted = self.converted.get(key)
+            if converted is None:
+                converted = self.converter.convert_text(source)
+                self.converted.put(key, converted)
+        finally:
+            lock.release()
+        return converted
+
+    def uptodate_function(self, filename, digest):
+        # Returns the function Jinja calls to tell whether the template
+        # in filename, whose source has digest, is unchanged.
+        checked = [os.path.getmtime(filename)]
+        encoding = self.encoding
+        def uptodate():
+            try:
+                mtime = os.path.getmtime(filename)
+                if mtime == checked[0]:
+                    return True
+                f = open(filename, 'rb')
+                try:
+                    current = f.read().decode(encoding)
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                return False
+            if source_digest(current) != digest:
+                return False
+            # touched but not changed
+            checked[0] = mtime
+            return True
+        return uptodate
+
+def source_digest(source):
+    return hashlib.sha1(source.encode('utf-8')).digest()
+
+# Line breaks other than \n, which Jinja's lexer also splits lines at.
+OTHER_LINE_BREAKS = re.compile(u'[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+NAME = r'[a-zA-Z_][a-zA-Z0-9_]*'
+
+# Versions of Jinja2, from and up to but excluding, whose Lexer.tokeniter,
+# Lexer.wrap and Parser.stream parse_template works with.
+DIRECT_JINJA_VERSIONS = ((2, 11), (3, 0))
+
+def supports_direct_parsing(version=None):
+    ''' Returns True if parse_template can parse templates for version
+    of Jinja2, the installed one by default.
+    '''
+
+    if version is None:
+        version = jinja2.__version__
+    match = re.match(r'(\d+)\.(\d+)', version)
+    if match is None:
+        return False
+    version = (int(match.group(1)), int(match.group(2)))
+    return DIRECT_JINJA_VERSIONS[0] <= version < DIRECT_JINJA_VERSIONS[1]
+
+def parse_template(environment, source, name=None, filename=None):
+    ''' Parses source, a template converted by aml, into the same
+    jinja2.nodes.Template as environment.parse, for environment.compile.
+
+    Most lines of converted templates are plain markup or hold only the
+    simple tags aml writes, such as {{ name }} or {% endif %}. Their tokens
+    are made here directly, and only the other lines go through Jinja's
+    lexer; Jinja's parser then builds the template from the tokens.
+    Lines are lexed together with their neighbours where whitespace
+    control (-%} and the like) strips whitespace there, and with the
+    lines after them where a tag, comment or raw block continues.
+
+    With versions of Jinja2 outside DIRECT_JINJA_VERSIONS, source is
+    parsed with environment.parse instead.
+    '''
+
+    if not supports_direct_parsing() or OTHER_LINE_BREAKS.search(source):
+        return environment.parse(source, name, filename)
+    # made first, as it preprocesses an empty template
+    parser = jinja2.parser.Parser(environment, u'', name, filename)
+    text = environment.preprocess(source, name, filename)
+    lexer = environment.lexer
+    if not lexer.keep_trailing_newline and text.endswith('\n'):
+        text = text[:-1]
+
+    starts = [environment.block_start_string, environment.variable_start_string,
+        environment.comment_start_string]
+    ends = [environment.block_end_string, environment.variable_end_string,
+        environment.comment_end_string]
+    strip_before = [start + '-' for start in starts]
+    strip_after = ['-' + end for end in ends]
+    markers = list(starts)
+    for prefix in (environment.line_statement_prefix, environment.line_comment_prefix):
+        if prefix:
+            markers.append(prefix)
+            # line statements and comments end with the blank lines after them
+            strip_after.append(prefix)
+    # {{ name.attribute }}, and {% name %} where no blocks are trimmed
+    simple = [r'(?P<variable_begin>%s)[ \t]*(?P<variable>%s(?:\.%s)*)[ \t]*(?P<variable_end>%s)'
+        % (re.escape(environment.variable_start_string), NAME, NAME,
+        re.escape(environment.variable_end_string))]
+    if not environment.trim_blocks and not environment.lstrip_blocks:
+        simple.append(r'(?P<block_begin>%s)[ \t]*(?!raw\b)(?P<block>%s)[ \t]*(?P<block_end>%s)'
+            % (re.escape(environment.block_start_string), NAME,
+            re.escape(environment.block_end_string)))
+    simple_tag = re.compile('|'.join(simple))
+
+    # runs of lines as [kind, text, first line number]
+    runs = []
+    number = 1
+    for line in text.splitlines(True):
+        kind = DATA
+        for marker in markers:
+            if marker in line:
+                kind = LEX
+                break
+        if kind is LEX:
+            rest = simple_tag.sub('', line)
+            for marker in markers:
+                if marker in rest:
+                    break
+            else:
+                kind = SIMPLE
+        if runs and runs[-1][0] is kind:
+            runs[-1][1] += line
+        else:
+            runs.append([kind, line, number])
+        number += 1
+    for index, run in enumerate(runs):
+        if run[0] is not LEX:
+            continue
+        for marker in strip_before:
+            if marker in run[1]:
+                lex_blank_runs(runs, range(index - 1, -1, -1))
+        for marker in strip_after:
+            if marker in run[1]:
+                lex_blank_runs(runs, range(index + 1, len(runs)))
+
+    tokens = []
+    index = 0
+    while index < len(runs):
+        kind, run, first = runs[index]
+        index += 1
+        while index < len(runs) and runs[index][0] is kind:
+            run += runs[index][1]
+            index += 1
+        if kind is DATA:
+            append_data(tokens, first, run)
+            continue
+        if kind is SIMPLE:
+            append_simple_tags(tokens, first, run, simple_tag)
+            continue
+        chunk = run
+        if not lexer.keep_trailing_newline and chunk.endswith('\n'):
+            # the lexer drops the last line break
+            chunk += '\n'
+        try:
+            chunk_tokens = list(lexer.tokeniter(chunk, name, filename))
+        except jinja2.TemplateSyntaxError:
+            chunk_tokens = None
+        if chunk_tokens is None or tag_left_open(chunk_tokens):
+            if index == len(runs):
+                return environment.parse(source, name, filename)
+            # lexed with the rest, as a tag, comment or raw block continues
+            runs[index:] = [[LEX, run + ''.join([r[1] for r in runs[index:]]), first]]
+            continue
+        for lineno, token, value in chunk_tokens:
+            if token == 'data':
+                append_data(tokens, lineno + first - 1, value)
+            else:
+                tokens.append((lineno + first - 1, token, value))
+
+    stream = jinja2.lexer.TokenStream(lexer.wrap(tokens, name, filename),
+        name, filename)
+    for extension in environment.iter_extensions():
+        stream = extension.filter_stream(stream)
+        if not isinstance(stream, jinja2.lexer.TokenStream):
+            stream = jinja2.lexer.TokenStream(stream, name, filename)
+    parser.stream = stream
+    return parser.parse()
+
+# kinds of runs of lines in parse_template
+DATA, SIMPLE, LEX = 'data', 'simple', 'lex'
+
+def lex_blank_runs(runs, indices):
+    # Lexes the runs at indices up to the first one with more than whitespace.
+    for index in indices:
+        runs[index][0] = LEX
+        if runs[index][1].strip():
+            break
+
+def append_simple_tags(tokens, lineno, text, simple_tag):
+    # Appends the tokens Jinja's lexer makes of text, whose tags all match
+    # simple_tag; a tag ends on the line it starts on.
+    position = 0
+    for match in simple_tag.finditer(text):
+        if match.start() > position:
+            data = text[position:match.start()]
+            append_data(tokens, lineno, data)
+            lineno += data.count('\n')
+        tag = match.group('variable') and 'variable' or 'block'
+        tokens.append((lineno, tag + '_begin', match.group(tag + '_begin')))
+        names = match.group(tag).split('.')
+        tokens.append((lineno, 'name', names[0]))
+        for attribute in names[1:]:
+            tokens.append((lineno, 'operator', '.'))
+            tokens.append((lineno, 'name', attribute))
+        tokens.append((lineno, tag + '_end', match.group(tag + '_end')))
+        position = match.end()
+    if position < len(text):
+        append_data(tokens, lineno, text[position:])
+
+def tag_left_open(tokens):
+    # True if tokens end inside a tag, as a tag spanning lines would.
+    for lineno, token, value in reversed(tokens):
+        if token.endswith('_end'):
+            return False
+        if token.endswith('_begin'):
+            return True
+    return False
+
+def append_data(tokens, lineno, value):
+    # Jinja's lexer emits text between tags as a single data token.
+    if tokens and tokens[-1][1] == 'data':
+        tokens[-1] = (tokens[-1][0], 'data', tokens[-1][2] + value)
+    else:
+        tokens.append((lineno, 'data', value))
+
+def precompile(searchpath, target=None, bytecode_cache=None, environment=None,
+        converter=None, extensions=('.at',), zip='deflated', log_function=None):
+    ''' Converts and compiles all templates found in searchpath, a
+    directory or list of directories, so that programs using them do
+    neither when they start.
+
+    With target, compiled templates are written to target, a zip archive
+    or a directory if zip is None, which jinja2.ModuleLoader(target)
+    loads templates from. Template names are unchanged, including the
+    .at extension.
+
+    With bytecode_cache, a jinja2.BytecodeCache, compiled templates are
+    stored in it, for environments with an AmlLoader for searchpath and
+    that bytecode cache.
+
+    Templates are compiled for environment, by default a default
+    jinja2.Environment; its options must be those of the environment
+    the templates are used in. converter and extensions are passed to
+    AmlLoader. Errors in templates are raised.
+    '''
+
+    import sys
+
+    if environment is None:
+        environment = jinja2.Environment()
+    loader = AmlLoader(searchpath, converter=converter, extensions=extensions)
+    environment = environment.overlay(loader=loader, bytecode_cache=bytecode_cache)
+    if target is not None:
+        options = {}
+        if sys.version_info[0] < 3:
+            # Python 2 imports compiled templates without compiling them
+            options['py_compile'] = True
+        environment.compile_templates(target, zip=zip, log_function=log_function,
+            ignore_errors=False, **options)
+    if bytecode_cache is not None:
+        for name in environment.list_templates():
+            if log_function is not None:
+                log_function('Compiling %s' % name)
+            environment.get_template(name)
+
+def environment_from_argument(argument):
+    # Returns the environment named by argument, module:attribute.
+    module_name, attribute = argument.split(':', 1)
+    module = __import__(module_name)
+    for name in module_name.split('.')[1:]:
+        module = getattr(module, name)
+    return getattr(module, attribute)
+
+if __name__ == '__main__':
+    import optparse, sys
+    parser = optparse.OptionParser(
+        usage='Usage: %prog -o archive [options] directory...\n'
+        '       %prog --bytecode-cache DIR [options] directory...')
+    parser.add_option('-o', '--output', metavar='FILE',
+        help='Write compiled templates to the zip archive FILE, for jinja2.ModuleLoader')
+    parser.add_option('--output-dir', metavar='DIR',
+        help='Write compiled templates to DIR, for jinja2.ModuleLoader')
+    parser.add_option('--bytecode-cache', metavar='DIR',
+        help='Store compiled templates in a jinja2.FileSystemBytecodeCache in DIR')
+    parser.add_option('-e', '--environment', metavar='MODULE:NAME',
+        help='Compile for the jinja2.Environment NAME in MODULE')
+    parser.add_option('-v', '--verbose', action='store_true',
+        help='List templates as they are compiled')
+    options, args = parser.parse_args()
+    if not args or not (options.output or options.output_dir or options.bytecode_cache):
+        parser.print_help()
+        exit(2)
+    if options.output and options.output_dir:
+        parser.error('-o and --output-dir cannot be used together')
+    environment = None
+    if options.environment:
+        sys.path.insert(0, '.')
+        environment = environment_from_argument(options.environment)
+    bytecode_cache = None
+    if options.bytecode_cache:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(options.bytecode_cache)
+    log_function = None
+    if options.verbose:
+        def log_function(message):
+            sys.stderr.write(message + '\n')
+    zip = 'deflated'
+    target = options.output
+    if options.output_dir:
+        zip, target = None, options.output_dir
+    precompile(args, target, bytecode_cache, environment, zip=zip,
+        log_function=log_function)
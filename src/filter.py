@@ -1,7 +1,9 @@
 HTML_COMMENT_SYNTAX = '<!-- %s -->'
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
 
-def parse_arguments():
-    ''' Parses options and arguments for filter scripts.
+def parse_arguments(args=None):
+    ''' Parses options and arguments for filter scripts, given in args
+    or else on the command line.
     
     Without arguments, converts stdin to stdout.
     With a single argument converts specified filename to stdout,
@@ -9,23 +11,77 @@ def parse_arguments():
     Accepts one option, -o output-file which causes output
     to be written to output-file instead of stdout.
     
-    Returns a tuple (input, output) where input is None
-    to use standard input or file name, and output is None
-    to use standard output or file name.
+    With -d output-dir, any number of files, directories and
+    glob patterns are converted in batch mode instead, and
+    their names are stored in options.inputs.
+    
+    With -w, inputs are converted and then watched for changes.
+    This requires batch mode or named input and output files.
+    
+    With --daemon, no input is given; conversions are requested by
+    clients instead, see serve_conversions.
+    
+    Returns a tuple (input, output, options) where input is None
+    to use standard input or file name, output is None
+    to use standard output or file name, and options are the
+    parsed options. In batch mode and with --daemon, input and
+    output are both None.
     '''
     
     import optparse
     
-    usage = 'Usage: %prog [options] [input-file]'
+    usage = 'Usage: %prog [options] [input-file]\n       %prog [options] -d output-dir input...'
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-o', '--output', metavar='FILE',
-        help='Write output to FILE')
+        help='Write output to FILE, replacing it only once conversion succeeds '
+        '(standard output receives converted text as it goes, even if an error follows)')
     parser.add_option('-g', '--generated-warning', action='store_true',
         help='Add generated file warning to output')
     parser.add_option('-c', '--comment-syntax', metavar='FORMAT',
         help='Comment syntax to use (e.g. "<!-- %s -->" for HTML comments, which is the default). %s will be replaced with comment text. Literal percent signs should be doubled like so: %%')
+    parser.add_option('--cache-dir', metavar='DIR',
+        help='Reuse output of earlier conversions of the same input, kept in DIR')
+    parser.add_option('--cache-size', metavar='BYTES', type='int',
+        default=DEFAULT_CACHE_SIZE,
+        help='Limit the size of the cache directory to about BYTES (default %default)')
+    parser.add_option('-d', '--output-dir', metavar='DIR',
+        help='Convert input files, directories and glob patterns into DIR, mirroring directories')
+    parser.add_option('-j', '--jobs', metavar='N', type='int',
+        help='Convert with N processes in batch mode or with --parallel (default: one per CPU)')
+    parser.add_option('--parallel', action='store_true',
+        help='Split a single input at top-level blocks and convert the parts in parallel')
+    parser.add_option('-w', '--watch', action='store_true',
+        help='Convert inputs again whenever they change, until interrupted')
+    parser.add_option('--poll', metavar='SECONDS', type='float',
+        help='Watch by checking inputs every SECONDS instead of using inotify')
+    parser.add_option('--stats', action='store_true',
+        help='Print statistics on conversion stages to standard error')
+    parser.add_option('--profile', metavar='FILE',
+        help='Save a cProfile profile of the conversion to FILE')
+    parser.add_option('--daemon', metavar='ADDRESS',
+        help='Serve conversion requests on the Unix socket ADDRESS, or on standard input and output if ADDRESS is -')
+    parser.add_option('--connect', metavar='ADDRESS',
+        help='Have the conversion daemon listening on ADDRESS convert')
+    
+    options, args = parser.parse_args(args)
     
-    options, args = parser.parse_args()
+    if options.daemon is not None:
+        if args:
+            parser.print_help()
+            exit(2)
+        return (None, None, options)
+    
+    if options.output_dir is not None:
+        if not args or options.output is not None:
+            parser.print_help()
+            exit(2)
+        options.inputs = args
+        return (None, None, options)
+    
+    if options.watch and (len(args) != 1 or args[0] == '-'
+            or options.output in (None, '-')):
+        parser.print_help()
+        exit(2)
     
     # if file name is given convert file, else convert stdin.
     # - is alias for stdin.
@@ -46,7 +102,7 @@ def parse_arguments():
     
     return (input, output, options)
 
-def perform_conversion(convert_func, forward_arguments=False, pass_input_name=False):
+def perform_conversion(convert_func, forward_arguments=False, pass_input_name=False, stream=False, cache_key=None, extensions=None, stats=None, parallel=None, args=None):
     ''' Converts text in input file or standard input using
     convert_func and writes results to output file or
     standard output as specified by program options.
@@ -67,11 +123,380 @@ def perform_conversion(convert_func, forward_arguments=False, pass_input_name=Fa
     file name or path specified by user) is given to
     convert_func. If forward_arguments is True, convert_func
     is also given an output keyword argument.
+    
+    If stream is True, convert_func is given an iterable
+    of text chunks instead of a string and returns one too.
+    
+    With the --watch option, conversion is repeated whenever an
+    input changes, see watch_conversion.
+    
+    cache_key is a string identifying convert_func's code and
+    configuration, or a function returning one, for example
+    aml.Converter.configuration_key. If it is given and the
+    --cache-dir option is used, output is kept in a DiskCache and
+    reused for identical input.
+    
+    extensions is a pair (input extension, output extension)
+    used in batch mode, see find_files.
+    
+    stats is a function starting the collection of statistics, for
+    example aml.Converter.collect_stats. It is called if the --stats
+    option is used, and the report method of what it returns gives the
+    text printed once conversion is done. With --stats or --profile,
+    batch mode converts in this process only.
+    
+    parallel is a function converting a string like convert_func, given
+    the number of processes to use (or None for one per CPU), for
+    example aml.Converter.convert_parallel. It is used instead of
+    convert_func outside batch mode if the --parallel option is used.
+    
+    args are the command line arguments, by default sys.argv[1:]. With
+    the --daemon option, conversion requests are served instead, see
+    serve_conversions; with --connect, the daemon is asked to convert,
+    and conversion happens here only if there is no daemon.
     '''
     
     import sys
     
-    input, output, options = parse_arguments()
+    input, output, options = parse_arguments(args)
+    settings = ConversionSettings(convert_func, forward_arguments,
+        pass_input_name, stream, cache_key, extensions, stats, parallel)
+    
+    if options.daemon is not None:
+        serve_conversions(options.daemon, settings)
+        return
+    if options.connect is not None:
+        if args is None:
+            args = sys.argv[1:]
+        status = request_conversion(options.connect, args, input, options)
+        if status is not None:
+            exit(status)
+        sys.stderr.write('No conversion daemon is listening on %s, converting here\n'
+            % options.connect)
+    convert_with_options(input, output, options, settings)
+
+class ConversionSettings(object):
+    # The arguments of perform_conversion other than args, handed on to
+    # the functions performing conversions.
+    def __init__(self, convert_func, forward_arguments=False,
+            pass_input_name=False, stream=False, cache_key=None,
+            extensions=None, stats=None, parallel=None):
+        self.convert_func = convert_func
+        self.forward_arguments = forward_arguments
+        self.pass_input_name = pass_input_name
+        self.stream = stream
+        self.cache_key = cache_key
+        self.extensions = extensions
+        self.stats = stats
+        self.parallel = parallel
+    
+    def replace(self, **changes):
+        # Returns a copy of these settings with changes applied.
+        import copy
+        
+        settings = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(settings, name):
+                raise TypeError('Unknown setting: %s' % name)
+            setattr(settings, name, value)
+        return settings
+
+def convert_with_options(input, output, options, settings):
+    # Performs the conversion options ask for with settings, a
+    # ConversionSettings.
+    import sys
+    
+    convert_func = settings.convert_func
+    forward_arguments = settings.forward_arguments
+    pass_input_name = settings.pass_input_name
+    stream = settings.stream
+    cache_key = settings.cache_key
+    extensions = settings.extensions
+    stats = settings.stats
+    parallel = settings.parallel
+    
+    collected = None
+    if options.stats:
+        if stats is None:
+            sys.stderr.write('Statistics are not available for this conversion\n')
+        else:
+            collected = stats()
+    if options.stats or options.profile:
+        # workers would collect statistics out of reach
+        options.jobs = 1
+    
+    profile = None
+    if options.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        if options.parallel and options.output_dir is None and not pass_input_name:
+            if parallel is None:
+                sys.stderr.write('Parallel conversion is not available for this conversion\n')
+            else:
+                convert_func = ParallelConversion(parallel, options.jobs)
+                stream = False
+        run_conversion(convert_func, input, output, options, forward_arguments,
+            pass_input_name, stream, cache_key, extensions)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(options.profile)
+        if collected is not None:
+            sys.stderr.write(collected.report())
+
+def run_conversion(convert_func, input, output, options, forward_arguments,
+        pass_input_name, stream, cache_key, extensions):
+    # Performs the conversion perform_conversion was asked for.
+    import sys
+    
+    cache = None
+    if cache_key is not None and options.cache_dir and not pass_input_name:
+        cache = DiskCache(options.cache_dir, options.cache_size)
+        # hashing aml's code is left out of conversions without a cache
+        if callable(cache_key):
+            cache_key = cache_key()
+    
+    if options.watch:
+        if options.output_dir is not None:
+            def list_files():
+                return find_files(options.inputs, options.output_dir, extensions)
+        else:
+            def list_files():
+                return [(input, output)]
+        watch_conversion(convert_func, list_files, options, forward_arguments,
+            pass_input_name, stream, cache, cache_key, extensions)
+        return
+    
+    if options.output_dir is not None:
+        batch_conversion(convert_func, options, forward_arguments,
+            pass_input_name, stream, cache, cache_key, extensions)
+        return
+    
+    if stream and cache is None and not pass_input_name:
+        stream_conversion(convert_func, input, output, options, forward_arguments)
+        return
+    
+    output_text = convert_input(convert_func, input, output, forward_arguments,
+        pass_input_name, stream, cache, cache_key)
+    
+    output_text = generated_warning(input, options) + output_text
+    
+    if output is None:
+        sys.stdout.write(output_text)
+    else:
+        f = open(output, 'w')
+        try:
+            f.write(output_text)
+        finally:
+            f.close()
+
+def serve_conversions(address, settings):
+    ''' Serves conversion requests until interrupted, sparing each
+    conversion the start of an interpreter and the set up of aml.
+    settings is a ConversionSettings holding the arguments of
+    perform_conversion.
+    
+    Requests arrive on the Unix socket address, or on standard input
+    if address is -. Each request is a JSON object on a line of its own,
+    and is answered with a JSON object on a line. Any number of requests
+    may be sent over one connection. Requests have these keys:
+    
+    arguments: the command line arguments of the conversion.
+    cwd: the directory relative file names are relative to, optional.
+    stdin: the text to convert if no input file is given, optional.
+    
+    Responses have these keys:
+    
+    exitCode: the exit status the filter would have exited with.
+    output: what the filter would have written to standard error.
+    stdout: what it would have written to standard output.
+    
+    A requestId in a request is copied into its response. This makes
+    the daemon a JSON persistent worker for build systems supporting
+    them. Requests are served one at a time; --watch and --daemon
+    cannot be requested, and statistics are not available.
+    '''
+    
+    import sys
+    
+    if address == '-':
+        serve_stream(sys.stdin, sys.stdout, settings)
+    else:
+        serve_socket(address, settings)
+
+def serve_socket(address, settings):
+    import os, sys, socket, stat
+    
+    if os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                probe.connect(address)
+            except socket.error:
+                # left behind by a daemon that was killed
+                os.remove(address)
+            else:
+                sys.stderr.write('A conversion daemon is already listening on %s\n'
+                    % address)
+                exit(1)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the owner may request conversions
+    umask = os.umask(stat.S_IRWXG | stat.S_IRWXO)
+    try:
+        server.bind(address)
+    finally:
+        os.umask(umask)
+    try:
+        server.listen(16)
+        sys.stderr.write('Serving conversions on %s\n' % address)
+        while True:
+            connection = server.accept()[0]
+            try:
+                serve_stream(connection.makefile('rb'), connection.makefile('wb'),
+                    settings)
+            except socket.error:
+                # the client went away
+                pass
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(address)
+
+def serve_stream(reader, writer, settings):
+    # Answers the requests read from reader on writer, until the end of
+    # reader.
+    import json
+    
+    while True:
+        line = reader.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        try:
+            request = json.loads(line)
+            request['arguments']
+        except (ValueError, TypeError, KeyError):
+            response = {'exitCode': 2, 'output': 'Invalid request\n', 'stdout': ''}
+        else:
+            response = daemon_request(request, settings)
+        data = json.dumps(response) + '\n'
+        if 'b' in getattr(writer, 'mode', ''):
+            data = data.encode('ascii')
+        writer.write(data)
+        writer.flush()
+
+def daemon_request(request, settings):
+    # Performs the conversion request asks for, as if the filter ran with
+    # its arguments in its directory, and returns the response.
+    import os, sys, traceback
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    
+    arguments = [native_string(argument) for argument in request['arguments']]
+    stdin = native_string(request.get('stdin') or '')
+    # statistics would be collected and reported across requests
+    settings = settings.replace(stats=None)
+    
+    directory = os.getcwd()
+    streams = sys.stdin, sys.stdout, sys.stderr
+    stdout, stderr = StringIO(), StringIO()
+    status = 0
+    try:
+        sys.stdin, sys.stdout, sys.stderr = StringIO(stdin), stdout, stderr
+        try:
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            input, output, options = parse_arguments(arguments)
+            if options.daemon is not None or options.watch:
+                sys.stderr.write('--daemon and --watch cannot be requested from a daemon\n')
+                exit(2)
+            convert_with_options(input, output, options, settings)
+        except SystemExit:
+            code = sys.exc_info()[1].code
+            if code is None:
+                status = 0
+            elif isinstance(code, int):
+                status = code
+            else:
+                sys.stderr.write('%s\n' % code)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+        os.chdir(directory)
+    response = {'exitCode': status, 'output': stderr.getvalue(),
+        'stdout': stdout.getvalue()}
+    if 'requestId' in request:
+        response['requestId'] = request['requestId']
+    return response
+
+def request_conversion(address, args, input, options):
+    ''' Asks the conversion daemon listening on the Unix socket address
+    to perform the conversion described by args, the command line
+    arguments, which parse_arguments turned into input and options.
+    
+    What the daemon answers for standard output and error is written
+    there. Returns the exit status of the conversion, or None if no
+    daemon is listening.
+    '''
+    
+    import os, sys, json, socket
+    
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(address)
+        except socket.error:
+            return None
+        request = {'arguments': list(args), 'cwd': os.getcwd()}
+        if input is None and options.output_dir is None:
+            request['stdin'] = sys.stdin.read()
+        connection.sendall((json.dumps(request) + '\n').encode('ascii'))
+        line = connection.makefile('rb').readline()
+    finally:
+        connection.close()
+    if not line:
+        sys.stderr.write('The conversion daemon on %s did not answer\n' % address)
+        return 1
+    response = json.loads(line.decode('utf-8'))
+    sys.stdout.write(native_string(response.get('stdout', '')))
+    sys.stderr.write(native_string(response.get('output', '')))
+    return response['exitCode']
+
+def native_string(text):
+    # JSON gives unicode strings; Python 2 reads and writes byte strings.
+    if not isinstance(text, str):
+        text = text.encode('utf-8')
+    return text
+
+class ParallelConversion(object):
+    # convert_func for --parallel, accepting the arguments convert_func
+    # may be given.
+    def __init__(self, parallel, processes):
+        self.parallel = parallel
+        self.processes = processes
+    
+    def __call__(self, text, input=None, output=None):
+        return self.parallel(text, self.processes)
+
+def convert_input(convert_func, input, output, forward_arguments=False,
+        pass_input_name=False, stream=False, cache=None, cache_key=None):
+    # Converts input file or standard input, see perform_conversion,
+    # and returns the converted text.
+    import sys
     
     if pass_input_name:
         if forward_arguments:
@@ -88,25 +513,656 @@ def perform_conversion(convert_func, forward_arguments=False, pass_input_name=Fa
             finally:
                 f.close()
         
-        if forward_arguments:
-            output_text = convert_func(input_text, input=input, output=output)
-        else:
-            output_text = convert_func(input_text)
+        output_text = None
+        if cache is not None:
+            if forward_arguments:
+                # convert_func may use the file names
+                key = cache.key(cache_key, input_text, input, output)
+            else:
+                key = cache.key(cache_key, input_text)
+            output_text = cache.get(key)
+        
+        if output_text is None:
+            if stream:
+                input_text = [input_text]
+            if forward_arguments:
+                output_text = convert_func(input_text, input=input, output=output)
+            else:
+                output_text = convert_func(input_text)
+            if stream:
+                output_text = ''.join(output_text)
+            if cache is not None and output_text:
+                cache.put(key, output_text)
     
     assert output_text, "convert_func did not return anything to perform_conversion"
+    return output_text
+
+def find_files(paths, output_dir, extensions=None):
+    ''' Lists files to convert in batch mode as (input, output)
+    pairs of file names.
     
-    if options.generated_warning:
-        comment_syntax = options.comment_syntax or HTML_COMMENT_SYNTAX
-        warning = comment_syntax % 'Generated file - DO NOT EDIT' + "\n"
-        if input is not None:
-            warning += comment_syntax % ('Created from: %s' % input) + "\n"
-        output_text = warning + output_text
+    paths are file names, directories and glob patterns. Files
+    in directories are found recursively and their outputs go to
+    the same subdirectories of output_dir. Other outputs go to
+    output_dir itself.
     
-    if output is None:
-        sys.stdout.write(output_text)
-    else:
+    extensions is a pair (input extension, output extension).
+    Only files with the input extension are taken from
+    directories, and the input extension of file names is
+    replaced with the output extension. Without extensions,
+    all files are taken and file names are kept.
+    
+    A file named by several paths, for example by a directory and
+    by a glob pattern in it, is listed once, for the first of them.
+    '''
+    
+    import os, glob
+    
+    if extensions is None:
+        extensions = ('', '')
+    extension, output_extension = extensions
+    
+    def output_name(name):
+        if extension and name.endswith(extension):
+            name = name[:-len(extension)]
+        return name + output_extension
+    
+    files = []
+    seen = set()
+    def add(input, output):
+        # converting a file twice at once would mix up its output
+        key = os.path.realpath(input)
+        if key not in seen:
+            seen.add(key)
+            files.append((input, output))
+    
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, names in os.walk(path):
+                subdirectories.sort()
+                relative = os.path.relpath(directory, path)
+                for name in sorted(names):
+                    if name.endswith(extension):
+                        add(os.path.join(directory, name),
+                            os.path.normpath(os.path.join(output_dir,
+                                relative, output_name(name))))
+            continue
+        if os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise IOError('No such file, directory or pattern: %s' % path)
+        for match in matches:
+            if os.path.isfile(match):
+                add(match, os.path.join(output_dir,
+                    output_name(os.path.basename(match))))
+    return files
+
+def convert_files(convert_func, files, processes=None, forward_arguments=False,
+        pass_input_name=False, stream=False, cache=None, cache_key=None, warning=None):
+    ''' Converts files, a list of (input, output) file name pairs, with
+    convert_func in a pool of processes, one per CPU unless processes
+    is given. Arguments are as for perform_conversion; warning is a
+    function returning the text to put before the output of an input
+    file, see generated_warning.
+    
+    Largest files are converted first. Yields a tuple (input, output,
+    seconds, error) for each file as soon as it is converted, where
+    seconds is the time the conversion took and error is None or a
+    description of the exception that made it fail.
+    
+    convert_func is handed to worker processes when they start. This
+    works for any function where processes are forked, elsewhere it
+    must be picklable.
+    '''
+    
+    import os
+    
+    def size(pair):
+        try:
+            return os.path.getsize(pair[0])
+        except OSError:
+            return 0
+    files = sorted(files, key=size, reverse=True)
+    settings = (convert_func, forward_arguments, pass_input_name, stream,
+        cache, cache_key, warning)
+    
+    if processes is None:
+        try:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            processes = 1
+    processes = min(processes, len(files))
+    if processes <= 1:
+        set_batch_settings(settings)
+        for pair in files:
+            yield convert_batch_file(pair)
+        return
+    
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, set_batch_settings, (settings,))
+    try:
+        for result in pool.imap_unordered(convert_batch_file, files):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+batch_settings = None
+
+def set_batch_settings(settings):
+    global batch_settings
+    batch_settings = settings
+
+def convert_batch_file(pair):
+    import sys, os, time, errno
+    
+    (convert_func, forward_arguments, pass_input_name, stream,
+        cache, cache_key, warning) = batch_settings
+    input, output = pair
+    start = time.time()
+    try:
+        output_text = convert_input(convert_func, input, output,
+            forward_arguments, pass_input_name, stream, cache, cache_key)
+        if warning is not None:
+            output_text = warning(input) + output_text
+        directory = os.path.dirname(output)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process may have created it
+                if sys.exc_info()[1].errno != errno.EEXIST:
+                    raise
         f = open(output, 'w')
         try:
             f.write(output_text)
         finally:
             f.close()
+    except Exception:
+        e = sys.exc_info()[1]
+        return (input, output, time.time() - start, '%s: %s' % (e.__class__.__name__, e))
+    return (input, output, time.time() - start, None)
+
+def batch_conversion(convert_func, options, forward_arguments, pass_input_name,
+        stream, cache, cache_key, extensions):
+    import sys, time
+    
+    files = find_files(options.inputs, options.output_dir, extensions)
+    start = time.time()
+    total = 0.0
+    failed = 0
+    warning = None
+    if options.generated_warning:
+        warning = BatchWarning(options)
+    results = convert_files(convert_func, files, options.jobs,
+        forward_arguments, pass_input_name, stream, cache, cache_key, warning)
+    for input, output, seconds, error in results:
+        total += seconds
+        if error is None:
+            sys.stderr.write('%8.3fs %s -> %s\n' % (seconds, input, output))
+        else:
+            failed += 1
+            sys.stderr.write('  FAILED %s: %s\n' % (input, error))
+    sys.stderr.write('Converted %d of %d files in %.3fs (%.3fs of conversion)\n'
+        % (len(files) - failed, len(files), time.time() - start, total))
+    if failed:
+        exit(1)
+
+class BatchWarning(object):
+    # generated_warning for one set of options, in a form that can be
+    # handed to worker processes.
+    def __init__(self, options):
+        self.generated_warning = options.generated_warning
+        self.comment_syntax = options.comment_syntax
+    
+    def __call__(self, input):
+        return generated_warning(input, self)
+
+def watch_conversion(convert_func, list_files, options, forward_arguments,
+        pass_input_name, stream, cache, cache_key, extensions):
+    ''' Converts the files list_files returns as (input, output) pairs,
+    then converts them again as they change until interrupted.
+    
+    Changes are detected with inotify where available, otherwise by
+    checking modification times every options.poll seconds. Only inputs
+    whose content hash changed are converted again, in this process, so
+    converters stay warm between changes. The time from detecting a
+    change to having written its output is reported on standard error.
+    '''
+    
+    import sys, os, time
+    
+    warning = None
+    if options.generated_warning:
+        warning = BatchWarning(options)
+    
+    # absolute input name -> (input, output, content digest)
+    watched = {}
+    def update(files, initial=False):
+        # converts those of files whose content changed
+        changed = []
+        for input, output in files:
+            key = os.path.abspath(input)
+            digest = file_digest(input)
+            entry = watched.get(key)
+            if digest is None or (entry is not None and entry[2] == digest
+                    and entry[1] == output):
+                continue
+            watched[key] = (input, output, digest)
+            changed.append((input, output))
+        if initial:
+            results = convert_files(convert_func, changed, options.jobs,
+                forward_arguments, pass_input_name, stream, cache, cache_key,
+                warning)
+        else:
+            set_batch_settings((convert_func, forward_arguments, pass_input_name,
+                stream, cache, cache_key, warning))
+            results = (convert_batch_file(pair) for pair in changed)
+        for input, output, seconds, error in results:
+            if not initial:
+                # latency from detecting the change
+                seconds = time.time() - detected
+            if error is None:
+                sys.stderr.write('%8.3fs %s -> %s\n' % (seconds, input, output))
+            else:
+                sys.stderr.write('  FAILED %s: %s\n' % (input, error))
+    
+    detected = time.time()
+    files = list_files()
+    update(files, True)
+    
+    if options.poll is None:
+        try:
+            changes = inotify_changes(watch_directories(files, options))
+        except (ImportError, AttributeError, OSError):
+            changes = None
+    if options.poll is not None or changes is None:
+        changes = polling_changes(list_files, options.poll or 1.0)
+    sys.stderr.write('Watching %d files for changes, interrupt to stop\n'
+        % len(files))
+    
+    if extensions is None:
+        extension = ''
+    else:
+        extension = extensions[0]
+    try:
+        for paths, detected in changes:
+            pending = []
+            relist = False
+            for path in paths:
+                entry = watched.get(path)
+                if entry is not None:
+                    pending.append(entry[:2])
+                elif path.endswith(extension):
+                    # possibly a new input
+                    relist = True
+            if relist:
+                try:
+                    pending = list_files()
+                except IOError:
+                    sys.stderr.write('  FAILED %s\n' % sys.exc_info()[1])
+            update(pending)
+    except KeyboardInterrupt:
+        pass
+
+def watch_directories(files, options):
+    # Lists (directory, recursive) pairs holding the inputs of files.
+    import os
+    
+    directories = {}
+    for path in getattr(options, 'inputs', ()):
+        if os.path.isdir(path):
+            directories[os.path.abspath(path)] = True
+    for input, output in files:
+        directory = os.path.dirname(os.path.abspath(input))
+        directories.setdefault(directory, False)
+    return list(directories.items())
+
+def file_digest(path):
+    # Returns a hash of the content of file at path, or None if it
+    # cannot be read.
+    import hashlib
+    
+    try:
+        f = open(path, 'rb')
+        try:
+            return hashlib.sha1(f.read()).digest()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+# inotify_event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+def inotify_changes(directories):
+    ''' Watches directories, a list of (directory, recursive) pairs,
+    with inotify. Returns an iterator yielding (paths, time) when files
+    are written or moved into the directories, where paths are the
+    absolute names of the files and time is when the first of them was
+    seen. Raises OSError if inotify is not available.
+    '''
+    
+    import os, sys, ctypes, ctypes.util
+    
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init()
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    
+    # watch descriptor -> (directory, recursive)
+    watches = {}
+    def add_watch(directory, recursive):
+        name = directory
+        if not isinstance(name, bytes):
+            name = name.encode(sys.getfilesystemencoding())
+        wd = libc.inotify_add_watch(fd, name,
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+        watches[wd] = (directory, recursive)
+        if recursive:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    add_watch(path, True)
+    
+    try:
+        for directory, recursive in directories:
+            add_watch(directory, recursive)
+    except:
+        os.close(fd)
+        raise
+    return read_inotify_events(fd, watches, add_watch)
+
+def read_inotify_events(fd, watches, add_watch):
+    import os, sys, select, struct, time
+    
+    header = struct.calcsize('iIII')
+    try:
+        while True:
+            select.select([fd], [], [])
+            detected = time.time()
+            paths = {}
+            # an editor saving a file makes several events in a row
+            while select.select([fd], [], [], 0.01)[0]:
+                data = os.read(fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + header:offset + header + length]
+                    offset += header + length
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, check everything
+                        for directory, recursive in watches.values():
+                            for name in os.listdir(directory):
+                                paths[os.path.join(directory, name)] = True
+                        continue
+                    if wd not in watches:
+                        continue
+                    directory, recursive = watches[wd]
+                    name = name.rstrip('\0'.encode('ascii'))
+                    if not isinstance(name, str):
+                        name = name.decode(sys.getfilesystemencoding())
+                    path = os.path.join(directory, name)
+                    if mask & IN_ISDIR:
+                        if recursive:
+                            try:
+                                add_watch(path, True)
+                            except OSError:
+                                continue
+                            # files may be in it already
+                            for directory, subdirectories, names in os.walk(path):
+                                for name in names:
+                                    paths[os.path.join(directory, name)] = True
+                    else:
+                        paths[path] = True
+            yield list(paths), detected
+    finally:
+        os.close(fd)
+
+def polling_changes(list_files, interval):
+    ''' Checks the inputs list_files returns every interval seconds.
+    Returns an iterator yielding (paths, time) when inputs appear or
+    their modification time or size changes, where paths are absolute
+    names of the inputs and time is when the change was found.
+    '''
+    
+    import os, time
+    
+    def stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+    
+    def scan():
+        try:
+            files = list_files()
+        except IOError:
+            files = []
+        return dict((os.path.abspath(input), stat(input)) for input, output in files)
+    
+    state = scan()
+    while True:
+        time.sleep(interval)
+        detected = time.time()
+        current = scan()
+        paths = [path for path, value in current.items()
+            if value is not None and state.get(path) != value]
+        state = current
+        if paths:
+            yield paths, detected
+
+def stream_conversion(convert_func, input, output, options, forward_arguments):
+    import sys, os
+    
+    if input is None:
+        input_file = sys.stdin
+    else:
+        input_file = open(input)
+    try:
+        if output is None:
+            output_file = sys.stdout
+        else:
+            # written next to output and renamed over it once converted,
+            # so that an error leaves output as it was
+            directory, name = os.path.split(output)
+            temporary = os.path.join(directory, '.%s.%d.tmp' % (name, os.getpid()))
+            output_file = open(temporary, 'w')
+        try:
+            if forward_arguments:
+                chunks = convert_func(input_file, input=input, output=output)
+            else:
+                chunks = convert_func(input_file)
+            
+            output_file.write(generated_warning(input, options))
+            written = False
+            for chunk in chunks:
+                output_file.write(chunk)
+                written = True
+            assert written, "convert_func did not return anything to perform_conversion"
+        except:
+            if output is not None:
+                output_file.close()
+                os.remove(temporary)
+            raise
+        if output is not None:
+            output_file.close()
+            os.rename(temporary, output)
+    finally:
+        if input is not None:
+            input_file.close()
+
+def generated_warning(input, options):
+    if not options.generated_warning:
+        return ''
+    comment_syntax = options.comment_syntax or HTML_COMMENT_SYNTAX
+    warning = comment_syntax % 'Generated file - DO NOT EDIT' + "\n"
+    if input is not None:
+        warning += comment_syntax % ('Created from: %s' % input) + "\n"
+    return warning
+
+class DiskCache(object):
+    ''' Keeps converted text in files under directory, one file per
+    conversion, named by a hash of the input and the converter's key.
+    
+    Entries are written to temporary files and renamed into place, so
+    any number of processes may share the directory: readers never see
+    partially written entries, and concurrent writers of the same entry
+    simply replace each other's identical output.
+    
+    Entries are spread over 16 subdirectories. After storing an entry,
+    the least recently used entries of its subdirectory are removed
+    until the subdirectory holds no more than a sixteenth of max_bytes,
+    keeping the whole directory within about max_bytes without
+    scanning all of it.
+    '''
+    
+    SUBDIRECTORIES = 16
+    
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+    
+    def key(self, *parts):
+        import hashlib
+        
+        digest = hashlib.sha1()
+        for part in parts:
+            if part is None:
+                part = ''
+            if not isinstance(part, bytes):
+                part = part.encode('utf-8')
+            # lengths keep the boundaries between parts unambiguous
+            digest.update(('%d:' % len(part)).encode('ascii'))
+            digest.update(part)
+        return digest.hexdigest()
+    
+    def path(self, key):
+        import os.path
+        
+        subdirectory = '%x' % (int(key[:2], 16) % self.SUBDIRECTORIES)
+        return os.path.join(self.directory, subdirectory, key)
+    
+    def get(self, key):
+        ''' Returns text stored under key, or None. '''
+        
+        import os
+        
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        try:
+            # recently used entries are the last to be removed
+            os.utime(path, None)
+        except OSError:
+            pass
+        if not isinstance(text, str):
+            text = text.decode('utf-8')
+        return text
+    
+    def put(self, key, text):
+        ''' Stores text under key. Failures to write are ignored, as
+        the cache is only an optimization.
+        '''
+        
+        import os, stat, tempfile
+        
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        path = self.path(key)
+        subdirectory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(subdirectory):
+                try:
+                    os.makedirs(subdirectory)
+                except OSError:
+                    # another process may have created it
+                    if not os.path.isdir(subdirectory):
+                        raise
+            fd, temporary = tempfile.mkstemp(prefix='.', dir=subdirectory)
+            try:
+                # mkstemp makes files private to their owner
+                os.chmod(temporary, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(text)
+                finally:
+                    f.close()
+                try:
+                    os.rename(temporary, path)
+                except OSError:
+                    # renaming onto an existing file fails on Windows
+                    os.remove(temporary)
+            except:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+        except (IOError, OSError):
+            return
+        self.prune(subdirectory)
+    
+    def prune(self, subdirectory):
+        import os, time
+        
+        limit = self.max_bytes // self.SUBDIRECTORIES
+        entries = []
+        total = 0
+        for name in os.listdir(subdirectory):
+            path = os.path.join(subdirectory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith('.'):
+                # temporary files of writers that died an hour ago or more
+                if stat.st_mtime < time.time() - 3600:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= limit:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
+            if total <= limit:
+                break
+
+if __name__ == "__main__":
+    # python filter.py --connect ADDRESS [options] [input] is a client of
+    # a conversion daemon that does not import aml.
+    import sys
+    input, output, options = parse_arguments()
+    if options.connect is None:
+        sys.stderr.write('filter.py converts through a daemon only, see --connect\n')
+        exit(2)
+    status = request_conversion(options.connect, sys.argv[1:], input, options)
+    if status is None:
+        sys.stderr.write('No conversion daemon is listening on %s\n' % options.connect)
+        status = 1
+    exit(status)
@@ -1,4 +1,5 @@
 import re
+import array
 
 __version__ = '0.99b'
 
@@ -12,26 +13,131 @@ def convert_text(in_body):
 PASS_SYNTAX = 'PASS'
 FLUSH_LEFT_SYNTAX = '|| '
 FLUSH_LEFT_EMPTY_LINE = '||'
-TAG_WHITESPACE_ATTRS = re.compile('(\S+)([ \t]*?)(.*)')
-TAG_AND_REST = re.compile(r'((?:[^ \t\.#]|\.\.)+)(.*)')
-CLASS_OR_ID = re.compile(r'([.#])((?:[^ \t\.#]|\.\.)+)')
-COMMENT_SYNTAX = re.compile(r'^::comment$')
 
-DIV_SHORTCUT = re.compile(r'^(?:#|(?:\.(?!\.)))')
+class LazyRegex(object):
+    # A regex compiled when first used, so that importing shpaml and aml
+    # compiles no regex a conversion does not use. Once compiled, the
+    # methods and attributes of the compiled regex are stored on the
+    # instance, and using them costs no more than on the regex itself.
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.options = flags
+    
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        regex = re.compile(self.pattern, self.options)
+        for attribute in REGEX_ATTRIBUTES:
+            if hasattr(regex, attribute):
+                setattr(self, attribute, getattr(regex, attribute))
+        return getattr(regex, name)
+
+REGEX_ATTRIBUTES = ('match', 'search', 'sub', 'subn', 'split', 'findall',
+    'finditer', 'fullmatch', 'scanner', 'flags', 'groups', 'groupindex')
+
+WHITESPACE = LazyRegex(r'\s')
+COMMENT_SYNTAX = LazyRegex(r'^::comment$')
+
+DIV_SHORTCUT = LazyRegex(r'^(?:#|(?:\.(?!\.)))')
 
-quotedText = r"""(?:(?:'(?:\\'|[^'])*')|(?:"(?:\\"|[^"])*"))"""
-AUTO_QUOTE = re.compile("""([ \t]+[^ \t=]+=)(""" + quotedText + """|[^ \t]+)""")
 def AUTO_QUOTE_ATTRIBUTES(attrs):
-    def _sub(m):
-        attr = m.group(2)
-        if attr[0] in "\"'":
-            return m.group(1) + attr
-        return m.group(1) + '"' + attr + '"'
-    return re.sub(AUTO_QUOTE, _sub,attrs)
-
-def syntax(regex):
+    # Quotes the values of name=value attributes that follow spaces or
+    # tabs. Values in single or double quotes are left alone; they end
+    # at the first matching quote not preceded by a backslash, or if
+    # there is none at the last one that is. Each of the characters
+    # searched for is looked for again only once passed, so attrs is
+    # scanned once and the cost is linear in its length.
+    if '=' not in attrs:
+        return attrs
+    if '"' not in attrs and "'" not in attrs and '\t' not in attrs:
+        # no quoted values: every word with a name and a value is one
+        words = attrs.split(' ')
+        for index in range(1, len(words)):
+            word = words[index]
+            equals = word.find('=')
+            if 0 < equals < len(word) - 1:
+                words[index] = '%s"%s"' % (word[:equals + 1], word[equals + 1:])
+        return ' '.join(words)
+    length = len(attrs)
+    space = tab = equals = -1
+    output = []
+    copied = 0
+    i = 0
+    while True:
+        if space < i:
+            space = attrs.find(' ', i)
+            if space < 0:
+                space = length
+        if tab < i:
+            tab = attrs.find('\t', i)
+            if tab < 0:
+                tab = length
+        name = min(space, tab)
+        if name == length:
+            break
+        name += 1
+        while name < length and attrs[name] in ' \t':
+            name += 1
+        if space < name:
+            space = attrs.find(' ', name)
+            if space < 0:
+                space = length
+        if tab < name:
+            tab = attrs.find('\t', name)
+            if tab < 0:
+                tab = length
+        if equals < name:
+            equals = attrs.find('=', name)
+            if equals < 0:
+                equals = length
+        value = equals + 1
+        if equals == name or equals == length or equals > space or equals > tab:
+            i = min(space, tab, equals)
+            if i == length:
+                break
+            continue
+        end = -1
+        if value < length and attrs[value] in '"\'':
+            end = quoted_end(attrs, value)
+        if end < 0:
+            end = min(space, tab)
+            if end == value:
+                i = value
+                continue
+            if attrs[value] not in '"\'':
+                output.append(attrs[copied:value])
+                output.append('"%s"' % attrs[value:end])
+                copied = end
+        i = end
+    if not output:
+        return attrs
+    output.append(attrs[copied:])
+    return ''.join(output)
+
+def quoted_end(text, start):
+    # The index just past the quoted value starting at start, or -1.
+    quote = text[start]
+    position = text.find(quote, start + 1)
+    while position >= 0:
+        if text[position - 1] != '\\':
+            return position + 1
+        position = text.find(quote, position + 1)
+    position = text.rfind('\\' + quote, start + 1)
+    if position >= 0:
+        return position + 2
+    return -1
+
+def syntax(regex, first=None, requires=None, nested=False):
+    # first lists the characters a matching line can start with and
+    # requires is a substring every matching line contains; both are
+    # optional hints that let convert_line skip hopeless regexes.
+    # Nested methods convert part of their line as a line of its own and
+    # are also given the convert_line function to use for it.
     def wrap(f):
-        f.regex = re.compile(regex)
+        f.regex = LazyRegex(regex)
+        f.first = first
+        f.requires = requires
+        f.nested = nested
         return f
     return wrap
 
@@ -43,26 +149,28 @@ def INDENT(m):
         prefix = ''
     return prefix, line
 
-@syntax('^([<{]\S.*)')
+@syntax('^([<{]\S.*)', first='<{')
 def RAW_HTML(m):
     return m.group(1).rstrip()
 
-@syntax('^\| (.*)')
+@syntax('^\| (.*)', first='|')
 def TEXT(m):
     return m.group(1).rstrip()
 
-@syntax('(.*?) > (.*)')
-def OUTER_CLOSING_TAG(m):
+@syntax('(.*?) > (.*)', requires=' > ', nested=True)
+def OUTER_CLOSING_TAG(m, convert=None):
     tag, text = m.groups()
-    text = convert_line(text)
+    if convert is None:
+        convert = convert_line
+    text = convert(text)
     return enclose_tag(tag, text)
 
-@syntax('(.*?) \| (.*)')
+@syntax('(.*?) \| (.*)', requires=' | ')
 def TEXT_ENCLOSING_TAG(m):
     tag, text = m.groups()
     return enclose_tag(tag, text)
 
-@syntax('> (.*)')
+@syntax('> (.*)', first='>')
 def SELF_CLOSING_TAG(m):
     tag = m.group(1).strip()
     return '<%s />' % apply_jquery(tag)[0]
@@ -80,6 +188,124 @@ LINE_METHODS = [
         RAW_TEXT,
         ]
 
+# Results of tag parsing and leaf line conversion are memoized, as
+# templates repeat the same tags and lines many times over.
+MEMO_SIZE = 4096
+MEMO_MAX_KEY = 256
+
+class BoundedMemo(object):
+    ''' Memoizes function, a function of one string argument.
+
+    At most max_entries results are kept; when that many are, they are
+    all dropped and the memo fills up again. Arguments longer than
+    MEMO_MAX_KEY are rarely repeated and are not memoized. hits and
+    misses count calls answered from the memo and calls of function.
+    '''
+
+    # result of arguments not in the memo
+    MISSING = object()
+
+    def __init__(self, function, max_entries=MEMO_SIZE):
+        self.function = function
+        self.max_entries = max_entries
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, argument):
+        results = self.results
+        # a single lookup, as another thread may clear results meanwhile
+        result = results.get(argument, self.MISSING)
+        if result is not self.MISSING:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = self.function(argument)
+        if len(argument) <= MEMO_MAX_KEY:
+            if len(results) >= self.max_entries:
+                results.clear()
+            results[argument] = result
+        return result
+
+    def clear(self):
+        self.results.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': lookups and float(self.hits) / lookups,
+            'entries': len(self.results),
+        }
+
+class LineClassifier(object):
+    ''' Picks the line method for a line in a single dispatch.
+
+    Methods are grouped by the first character of the lines they can
+    match, so a line is only tried against the methods that could match
+    it, in LINE_METHODS order.
+
+    convert_line is a BoundedMemo, so that lines converted before are
+    not converted again.
+    '''
+
+    def __init__(self, methods):
+        self.methods = list(methods)
+        self.dispatch = None
+        self.convert_line = BoundedMemo(self.convert_line_uncached)
+
+    def prepare(self):
+        # Builds the dispatch tables on first use, which compiles the
+        # methods' regexes.
+        def candidates(char):
+            return [(method.regex.match, method.requires, method, method.nested)
+                    for method in self.methods
+                    if method.first is None or (char is not None and char in method.first)]
+        self.fallback = candidates(None)
+        dispatch = {}
+        for method in self.methods:
+            for char in method.first or '':
+                if char not in dispatch:
+                    dispatch[char] = candidates(char)
+        self.dispatch = dispatch
+
+    def convert_line_uncached(self, line):
+        if self.dispatch is None:
+            self.prepare()
+        line = line.strip()
+        for match, requires, method, nested in self.dispatch.get(line[:1], self.fallback):
+            if requires is not None and requires not in line:
+                continue
+            m = match(line)
+            if m:
+                if nested:
+                    return method(m, self.convert_line)
+                return method(m)
+
+    def counting_convert_line(self, counts):
+        ''' Returns a function converting lines like convert_line that
+        also counts the lines each method converts in counts, a dict
+        keyed by method name. Its conversions are not memoized.
+        '''
+        if self.dispatch is None:
+            self.prepare()
+        dispatch, fallback = self.dispatch, self.fallback
+        def convert_line(line):
+            line = line.strip()
+            for match, requires, method, nested in dispatch.get(line[:1], fallback):
+                if requires is not None and requires not in line:
+                    continue
+                m = match(line)
+                if m:
+                    name = method.__name__
+                    counts[name] = counts.get(name, 0) + 1
+                    if nested:
+                        return method(m, convert_line)
+                    return method(m)
+        return convert_line
+
+line_classifier = LineClassifier(LINE_METHODS)
 
 def convert_shpaml_tree(in_body):
     return indent(in_body,
@@ -94,68 +320,95 @@ def html_block_tag(output, block, recurse):
     append = output.append
     prefix, tag = block[0]
     if RAW_HTML.regex.match(tag):
-        append(prefix + tag)
+        append((OUTPUT_TEXT, prefix, tag))
         recurse(block[1:])
     elif COMMENT_SYNTAX.match(tag):
         pass
     else:
         start_tag, end_tag = apply_jquery_sugar(tag)
-        append(prefix + start_tag)
+        append((OUTPUT_START_TAG, prefix, start_tag))
         recurse(block[1:])
-        append(prefix + end_tag)
+        append((OUTPUT_END_TAG, prefix, end_tag))
 
 def convert_line(line):
-    prefix, line = find_indentation(line.strip())
-    for method in LINE_METHODS:
-        m = method.regex.match(line)
-        if m:
-            return prefix + method(m)
+    return line_classifier.convert_line(line)
 
-def apply_jquery_sugar(markup):
+def apply_jquery_sugar_uncached(markup):
     if DIV_SHORTCUT.match(markup):
         markup = 'div' + markup
     start_tag, tag = apply_jquery(markup)
     return ('<%s>' % start_tag, '</%s>' % tag)
 
-def apply_jquery(markup):
-    tag, whitespace, attrs = TAG_WHITESPACE_ATTRS.match(markup).groups()
-    tag, rest = tag_and_rest(tag)
-    ids, classes = ids_and_classes(rest)
+def apply_jquery_uncached(markup):
+    m = WHITESPACE.search(markup)
+    if m:
+        tag, attrs = markup[:m.start()], markup[m.start():]
+    else:
+        tag, attrs = markup, ''
+    tag, ids, classes = parse_selector(tag)
     attrs = AUTO_QUOTE_ATTRIBUTES(attrs)
     if classes:
         attrs += ' class="%s"' % classes
     if ids:
         attrs += ' id="%s"' % ids
-    start_tag = tag + whitespace + attrs
+    start_tag = tag + attrs
     return start_tag, tag
 
-def ids_and_classes(rest):
-
-    if not rest: return '', ''
+apply_jquery_sugar = BoundedMemo(apply_jquery_sugar_uncached)
+apply_jquery = BoundedMemo(apply_jquery_uncached)
 
+def memo_stats():
+    ''' Returns the statistics of the memos of tag parsing, see
+    BoundedMemo.stats. LineClassifier.convert_line has its own.
+    '''
+    return {
+        'apply_jquery_sugar': apply_jquery_sugar.stats(),
+        'apply_jquery': apply_jquery.stats(),
+    }
+
+def parse_selector(selector):
+    # Splits tag.class#id sugar into the tag name, ids and classes in a
+    # single scan. Names end at a dot or hash; two dots stand for one.
+    if '.' not in selector and '#' not in selector:
+        return selector, '', ''
+    end = name_end(selector, 0)
+    if end == 0:
+        return fixdots(selector), '', ''
     ids = []
-    classes=[];
-
-    def _match(m):
-        if m.group(1) == '#':
-            ids.append(m.group(2))
+    classes = []
+    i = end
+    length = len(selector)
+    while i < length:
+        char = selector[i]
+        if char == '#' or char == '.':
+            stop = name_end(selector, i + 1)
+            if stop > i + 1:
+                name = fixdots(selector[i + 1:stop])
+                if char == '#':
+                    ids.append(name)
+                else:
+                    classes.append(name)
+                i = stop
+                continue
+        i += 1
+    return fixdots(selector[:end]), ' '.join(ids), ' '.join(classes)
+
+def name_end(selector, i):
+    length = len(selector)
+    while i < length:
+        char = selector[i]
+        if char == '.':
+            if selector[i + 1:i + 2] != '.':
+                break
+            i += 2
+        elif char == '#' or char == ' ' or char == '\t':
+            break
         else:
-            classes.append(m.group(2))
-
-    CLASS_OR_ID.sub(_match, rest)
-    return jfixdots(ids), jfixdots(classes)
+            i += 1
+    return i
 
-def jfixdots(a): return fixdots(' '.join(a))
 def fixdots(s): return s.replace('..', '.')
 
-
-def tag_and_rest(tag):
-    m = TAG_AND_REST.match(tag)
-    if m:
-        return fixdots(m.group(1)), m.group(2)
-    else:
-        return fixdots(tag), None
-
 def enclose_tag(tag, text):
     start_tag, end_tag = apply_jquery_sugar(tag)
     return start_tag + text + end_tag
@@ -165,6 +418,25 @@ def find_indentation(line):
 
 ############ Generic indentation stuff follows
 
+# Branch methods and indent_lines emit output records, which are
+# (kind, prefix, text) tuples; finish_output turns them into lines.
+# OUTPUT_TEXT records always keep their indentation. Whitespace removal
+# drops the indentation of the other kinds and joins block tags with
+# their neighbours.
+OUTPUT_TEXT = 0
+OUTPUT_LINE = 1
+OUTPUT_START_TAG = 2
+OUTPUT_END_TAG = 3
+
+BLANK_RECORD = (OUTPUT_TEXT, '', '')
+
+# Nesting is handled without Python recursion, so this limit only guards
+# against runaway input. NestingError is raised when it is exceeded.
+MAX_NESTING_DEPTH = 1000
+
+class NestingError(ValueError):
+    ''' Raised when blocks are nested more than MAX_NESTING_DEPTH levels deep. '''
+
 def get_indented_block(prefix_lines):
     prefix, line = prefix_lines[0]
     len_prefix = len(prefix)
@@ -186,12 +458,267 @@ def indent(text,
             flush_left_empty_line,
             indentation_method,
             get_block = get_indented_block,
+            finish_method = None,
+            memo = None,
             ):
-    text = text.rstrip()
-    lines = text.split('\n')
-    output = []
-    indent_lines(
-            lines,
+    prefix_lines = None
+    if len(text) >= COMPACT_LINES_MIN_SIZE and indentation_method is find_indentation:
+        prefix_lines = compact_lines(text)
+    if prefix_lines is None:
+        text = text.rstrip()
+        lines = text.split('\n')
+        output = []
+        indent_lines(
+                lines,
+                output,
+                branch_method,
+                leaf_method,
+                pass_syntax,
+                flush_left_syntax,
+                flush_left_empty_line,
+                indentation_method,
+                get_block,
+                finish_method,
+                memo,
+                )
+    else:
+        if finish_method is None:
+            finish_method = finish_output
+        converted = []
+        convert_prefix_lines(
+                prefix_lines,
+                converted,
+                branch_method,
+                leaf_method,
+                pass_syntax,
+                flush_left_syntax,
+                flush_left_empty_line,
+                get_block,
+                memo = memo,
+                ends = prefix_lines.ends,
+                )
+        prefix_lines = None
+        output = finish_method(converted)
+        converted = None
+    # joined with a newline after the last line without copying again,
+    # which is all there is if there are no lines
+    output.append('')
+    if len(output) == 1:
+        return '\n'
+    return '\n'.join(output)
+
+def find_block_ends(prefix_lines):
+    # Computes in a single pass what get_indented_block computes for every
+    # line: ends[i] is the index just past the block starting at line i.
+    # Entries for empty lines are not used.
+    ends = [0] * len(prefix_lines)
+    open_blocks = []
+    last = 0
+    i = 0
+    for prefix, line in prefix_lines:
+        if line:
+            width = len(prefix)
+            while open_blocks and open_blocks[-1][1] >= width:
+                ends[open_blocks.pop()[0]] = last
+            open_blocks.append((i, width))
+            last = i + 1
+        i += 1
+    for start, width in open_blocks:
+        ends[start] = last
+    return ends
+
+class LineSpan(object):
+    ''' A slice of (prefix, line) tuples that does not copy them.
+
+    Blocks handed to branch methods are line spans; block[0] is the block
+    header and block[1:] is another span covering the block's children.
+    limit is the stop of the span enclosing a block, where its siblings
+    end. offset is the number of source lines before lines[0], so that
+    lines[i] is line offset + i + 1 of the source.
+    '''
+
+    __slots__ = ('lines', 'ends', 'start', 'stop', 'limit', 'offset')
+
+    def __init__(self, lines, ends, start, stop, limit=None, offset=0):
+        self.lines = lines
+        self.ends = ends
+        self.start = start
+        self.stop = stop
+        if limit is None:
+            limit = stop
+        self.limit = limit
+        self.offset = offset
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        lines = self.lines
+        for i in range(self.start, self.stop):
+            yield lines[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.stop - self.start)
+            if step != 1:
+                return list(self)[index]
+            stop = max(start, stop)
+            return LineSpan(self.lines, self.ends,
+                    self.start + start, self.start + stop, None, self.offset)
+        if index < 0:
+            index += self.stop - self.start
+        if index < 0 or index >= self.stop - self.start:
+            raise IndexError(index)
+        return self.lines[self.start + index]
+
+    def line_number(self):
+        # The source line number of the first line of the span.
+        return self.offset + self.start + 1
+
+    def next_sibling(self):
+        ''' Returns the first line of the next sibling block that produces
+        output, or None. Blank lines, PASS lines and comment blocks are
+        skipped.
+        '''
+        lines, ends = self.lines, self.ends
+        i = self.stop
+        while i < self.limit:
+            line = lines[i][1]
+            if line == '' or (line == PASS_SYNTAX and ends[i] == i + 1):
+                i += 1
+            elif ends[i] > i + 1 and COMMENT_SYNTAX.match(line):
+                i = ends[i]
+            else:
+                return lines[i]
+        return None
+
+# Texts at least this long are converted with their lines kept as
+# CompactLines rather than (prefix, line) tuples, which take several
+# times the memory of the text.
+COMPACT_LINES_MIN_SIZE = 512 * 1024
+
+LEADING_SPACES = LazyRegex(' *')
+
+class CompactLines(object):
+    ''' The lines of a text as find_indentation splits them, kept as
+    offsets into the text instead of (prefix, line) tuples.
+
+    Each line takes an entry in three arrays: the width of its
+    indentation, and the start and stop of the rest of it, trailing
+    whitespace excluded, in text. Indexing builds a line's tuple when it
+    is needed; prefixes of the same width are shared. ends is what
+    find_block_ends returns for the lines.
+
+    Use compact_lines to make them.
+    '''
+
+    __slots__ = ('text', 'widths', 'starts', 'stops', 'ends', 'prefixes')
+
+    def __init__(self, text, widths, starts, stops, ends):
+        self.text = text
+        self.widths = widths
+        self.starts = starts
+        self.stops = stops
+        self.ends = ends
+        self.prefixes = {0: ''}
+
+    def __len__(self):
+        return len(self.widths)
+
+    def __iter__(self):
+        for i in range(len(self.widths)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.widths)))]
+        width = self.widths[index]
+        try:
+            prefix = self.prefixes[width]
+        except KeyError:
+            prefix = self.prefixes[width] = ' ' * width
+        return prefix, self.text[self.starts[index]:self.stops[index]]
+
+def compact_lines(text):
+    '''
+    Splits text into lines like indent does, returning them as
+    CompactLines, or None if a line is indented with tabs, which
+    CompactLines cannot represent. Block ends are found in the same pass.
+    '''
+    end = len(text)
+    while end and text[end - 1].isspace():
+        end -= 1
+    if end >= 1 << 31:
+        typecode = 'L'
+    else:
+        typecode = 'i'
+    widths = array.array(typecode)
+    starts = array.array(typecode)
+    stops = array.array(typecode)
+    ends = array.array(typecode)
+    open_blocks = []
+    last = 0
+    i = 0
+    match_spaces = LEADING_SPACES.match
+    find = text.find
+    position = 0
+    while True:
+        line_end = find('\n', position, end)
+        if line_end < 0:
+            line_end = end
+        start = match_spaces(text, position, line_end).end()
+        stop = line_end
+        while stop > start and text[stop - 1].isspace():
+            stop -= 1
+        if start == stop:
+            widths.append(0)
+            starts.append(position)
+            stops.append(position)
+            ends.append(0)
+        elif text[start] == '\t':
+            return None
+        else:
+            width = start - position
+            widths.append(width)
+            starts.append(start)
+            stops.append(stop)
+            ends.append(0)
+            while open_blocks and open_blocks[-1][1] >= width:
+                ends[open_blocks.pop()[0]] = last
+            open_blocks.append((i, width))
+            last = i + 1
+        i += 1
+        if line_end == end:
+            break
+        position = line_end + 1
+    for start, width in open_blocks:
+        ends[start] = last
+    return CompactLines(text, widths, starts, stops, ends)
+
+class ChildOutput(list):
+    # Placeholder left in a block's output by recurse; the lines of the
+    # block's children are collected into it and spliced in afterwards.
+    __slots__ = ()
+
+def flatten_output(segment, output):
+    append = output.append
+    pending = [iter(segment)]
+    while pending:
+        for item in pending[-1]:
+            if item.__class__ is ChildOutput:
+                pending.append(iter(item))
+                break
+            append(item)
+        else:
+            pending.pop()
+
+def finish_output(output):
+    # The default finish_method: turns the output records of every
+    # independently converted piece of text into the lines to emit.
+    # whitespace_removal.render_without_whitespace is the alternative.
+    return [prefix + text for kind, prefix, text in output]
+
+def indent_lines(lines,
             output,
             branch_method,
             leaf_method,
@@ -199,46 +726,212 @@ def indent(text,
             flush_left_syntax,
             flush_left_empty_line,
             indentation_method,
-            get_block = get_indented_block,
+            get_block,
+            finish_method = None,
+            memo = None,
+            ):
+    if finish_method is None:
+        finish_method = finish_output
+    prefix_lines = list(map(indentation_method, lines))
+    converted = []
+    convert_prefix_lines(
+            prefix_lines,
+            converted,
+            branch_method,
+            leaf_method,
+            pass_syntax,
+            flush_left_syntax,
+            flush_left_empty_line,
+            get_block,
+            memo = memo,
             )
-    return '\n'.join(output) + '\n'
+    output.extend(finish_method(converted))
 
-def indent_lines(lines,
+def convert_prefix_lines(prefix_lines,
             output,
             branch_method,
             leaf_method,
             pass_syntax,
             flush_left_syntax,
             flush_left_empty_line,
-            indentation_method,
             get_block,
+            stop = None,
+            memo = None,
+            ends = None,
+            offset = 0,
             ):
-    append = output.append
+    # Blocks are converted with an explicit work stack rather than Python
+    # recursion: recurse only queues the children of a block, and the
+    # output of every queued span is spliced into place at the end.
+    # Lines from stop on are only there for next_sibling to look at.
+    # ends, if given, is what find_block_ends returns for prefix_lines.
+    # offset is the number of source lines before prefix_lines[0], for
+    # line numbers in errors.
+    # memo, if given, is a block cache (see aml.BlockCache.view) holding
+    # the output records of blocks converted earlier with the same
+    # branch_method and leaf_method.
+    work = []
+    # (key, output) of blocks to store in memo once converted
+    to_memoize = []
+    if memo is not None and get_block is get_indented_block:
+        memo_depth = memo.depth
+    else:
+        memo_depth = 0
+    # the output segment, depth and span of the block being converted
+    current = [None, 0, None]
     def recurse(prefix_lines):
-        while prefix_lines:
-            prefix, line = prefix_lines[0]
+        segment, depth, block = current
+        if not isinstance(prefix_lines, LineSpan):
+            # lines made up by a branch method count as the block's children
+            prefix_lines = list(prefix_lines)
+            prefix_lines = LineSpan(prefix_lines,
+                    find_block_ends(prefix_lines), 0, len(prefix_lines),
+                    None, block.line_number())
+        if depth >= MAX_NESTING_DEPTH:
+            raise NestingError('Blocks nested more than %d levels deep at line %d'
+                    % (MAX_NESTING_DEPTH, prefix_lines.line_number()))
+        children = ChildOutput()
+        segment.append(children)
+        work.append((prefix_lines, children, depth + 1))
+    def convert_span(prefix_lines, segment, depth):
+        append = segment.append
+        all_lines, ends = prefix_lines.lines, prefix_lines.ends
+        i, stop = prefix_lines.start, prefix_lines.stop
+        while i < stop:
+            prefix, line = all_lines[i]
             if line == '':
-                prefix_lines.pop(0)
-                append('')
+                i += 1
+                append(BLANK_RECORD)
+                continue
+            if get_block is get_indented_block:
+                end = min(ends[i], stop)
             else:
-                block_size = get_block(prefix_lines)
-                if block_size == 1:
-                    prefix_lines.pop(0)
-                    if line == pass_syntax:
-                        pass
-                    elif line.startswith(flush_left_syntax):
-                        append(line[len(flush_left_syntax):])
-                    elif line.startswith(flush_left_empty_line):
-                        append('')
-                    else:
-                        append(prefix + leaf_method(line))
+                end = i + get_block(LineSpan(all_lines, ends, i, stop,
+                        None, prefix_lines.offset))
+            if end == i + 1:
+                i = end
+                if line == pass_syntax:
+                    pass
+                elif line.startswith(flush_left_syntax):
+                    append((OUTPUT_TEXT, '', line[len(flush_left_syntax):]))
+                elif line.startswith(flush_left_empty_line):
+                    append(BLANK_RECORD)
                 else:
-                    block = prefix_lines[:block_size]
-                    prefix_lines = prefix_lines[block_size:]
-                    branch_method(output, block, recurse)
-        return
-    prefix_lines = list(map(indentation_method, lines))
-    recurse(prefix_lines)
+                    append((OUTPUT_LINE, prefix, leaf_method(line)))
+            else:
+                block = LineSpan(all_lines, ends, i, end, prefix_lines.limit,
+                        prefix_lines.offset)
+                target = segment
+                if depth < memo_depth:
+                    # a block converts the same wherever its lines, its
+                    # depth and the sibling after it are the same; memo
+                    # tells converter configurations apart
+                    key = (depth, tuple(all_lines[i:end]), block.next_sibling())
+                    records = memo.get(key)
+                    if records is not None:
+                        append(records)
+                        i = end
+                        continue
+                    target = ChildOutput()
+                    append(target)
+                    to_memoize.append((key, target))
+                current[0] = target
+                current[1] = depth
+                current[2] = block
+                branch_method(target, block, recurse)
+                i = end
+    root = ChildOutput()
+    if stop is None:
+        stop = len(prefix_lines)
+    if ends is None:
+        ends = find_block_ends(prefix_lines)
+    work.append((LineSpan(prefix_lines, ends, 0, stop, len(prefix_lines),
+            offset), root, 0))
+    while work:
+        convert_span(*work.pop())
+    for key, target in to_memoize:
+        records = ChildOutput()
+        flatten_output(target, records)
+        memo.put(key, records)
+    flatten_output(root, output)
+
+def indent_stream(lines,
+            branch_method,
+            leaf_method,
+            pass_syntax,
+            flush_left_syntax,
+            flush_left_empty_line,
+            indentation_method,
+            get_block = get_indented_block,
+            finish_method = None,
+            memo = None,
+            ):
+    ''' Streaming counterpart of indent.
+
+    lines is an iterable of lines without line terminators. Yields lists
+    of output lines, one list per top-level block, as soon as the block
+    is complete. Concatenating the lists gives the lines indent would
+    have produced for the same text.
+    '''
+    if finish_method is None:
+        finish_method = finish_output
+    def convert(prefix_lines, offset, following=None):
+        # following is the first line of the next block, so that
+        # next_sibling sees what it would converting the whole text.
+        # offset is the number of lines read before prefix_lines[0].
+        stop = len(prefix_lines)
+        if following is not None:
+            prefix_lines.append(following)
+        output = []
+        convert_prefix_lines(
+                prefix_lines,
+                output,
+                branch_method,
+                leaf_method,
+                pass_syntax,
+                flush_left_syntax,
+                flush_left_empty_line,
+                get_block,
+                stop,
+                memo,
+                offset = offset,
+                )
+        return finish_method(output)
+    block = []
+    blank = []
+    width = None
+    converted_any = False
+    # lines read, and lines read before block[0]
+    count = 0
+    block_offset = 0
+    for line in lines:
+        count += 1
+        prefix_line = indentation_method(line)
+        if prefix_line[1] == '':
+            blank.append(prefix_line)
+            continue
+        # Lines that may produce no output stay with the preceding block,
+        # so that next_sibling sees past them, and so do lines nested in
+        # them.
+        if block and len(prefix_line[0]) <= width:
+            if (prefix_line[1] == pass_syntax
+                    or COMMENT_SYNTAX.match(prefix_line[1])):
+                width = len(prefix_line[0])
+            else:
+                yield convert(block, block_offset, prefix_line)
+                converted_any = True
+                block = []
+        if not block:
+            width = len(prefix_line[0])
+            block_offset = count - 1 - len(blank)
+        block.extend(blank)
+        blank = []
+        block.append(prefix_line)
+    # Trailing blank lines are dropped, as indent does by stripping text.
+    if block:
+        yield convert(block, block_offset)
+    elif not converted_any:
+        yield convert([indentation_method('')], 0)
 
 if __name__ == "__main__":
     # if file name is given convert file, else convert stdin
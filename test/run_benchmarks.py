@@ -0,0 +1,420 @@
+''' Benchmarks aml conversion on generated templates.
+
+Templates of increasing length are generated for each template engine
+and converted with and without whitespace removal. Every stage of the
+conversion is timed on its own, and peak memory use is measured in a
+separate process per template. Times growing faster than template
+length are reported, as are stages slower than in a baseline saved
+earlier with --output:
+
+python test/run_benchmarks.py --output before.json
+python test/run_benchmarks.py --baseline before.json
+
+With --startup, converting a single template from the command line is
+timed instead, starting the filter anew for each conversion and asking
+a conversion daemon to convert.
+'''
+
+import os, os.path, sys, time, random, optparse, json
+
+root = os.path.join(os.path.dirname(__file__), '..')
+
+ENGINES = {
+    'jinja': ('aml_jinja', 'JinjaShortcuts'),
+    'erb': ('aml_erb', 'ErbShortcuts'),
+}
+
+# Relative frequencies of the kinds of lines generated templates contain.
+DEFAULT_MIX = {
+    'tag': 4,
+    'statement': 2,
+    'expression': 2,
+    'text': 2,
+    'self_closing': 1,
+    'enclosing': 1,
+}
+
+# Line shortcuts per engine: statements opening blocks, expressions and
+# the else statement closing the previous block; * stands for a word.
+SHORTCUTS = {
+    'jinja': {
+        'statements': ['% if *', '% for item in *', '% block *', '% with x = *'],
+        'expression': '= *',
+        'else': '% else',
+        'text': ['*', '~ *', '| *'],
+    },
+    'erb': {
+        'statements': ['% if *', '% *.each do |item|', '% unless *'],
+        'expression': '= *',
+        'else': '% else',
+        'text': ['*', '| *'],
+    },
+}
+
+TAGS = ['div', 'p', 'li', 'span', 'td', 'a', 'ul', 'section']
+SELECTORS = ['', '.row', '#main', '.col.wide', '.num', '#nav.menu']
+ATTRIBUTES = ['href=/a/b', 'title="Some title"', "data-x='y z'", 'width=10', 'lang=en']
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+
+def generate_template(engine, lines=1000, depth=6, width=40, attributes=1.0,
+        mix=None, seed=0):
+    ''' Returns the text of an aml template for engine ('jinja' or 'erb').
+    
+    The template has lines lines nested up to depth levels deep. Text
+    is padded to about width characters, tags get attributes attributes
+    on average, and mix maps kinds of lines (see DEFAULT_MIX) to their
+    relative frequency. The same arguments give the same template.
+    '''
+    
+    rng = random.Random(seed)
+    shortcuts = SHORTCUTS[engine]
+    if mix is None:
+        mix = DEFAULT_MIX
+    kinds = []
+    for kind, weight in sorted(mix.items()):
+        kinds.extend([kind] * weight)
+    
+    def words(length):
+        text = []
+        while len(' '.join(text)) < length:
+            text.append(rng.choice(WORDS))
+        return ' '.join(text)
+    
+    def tag():
+        markup = rng.choice(TAGS) + rng.choice(SELECTORS)
+        count = int(attributes) + (rng.random() < attributes % 1)
+        for i in range(count):
+            markup += ' ' + rng.choice(ATTRIBUTES)
+        return markup
+    
+    output = []
+    # for each open block, whether it is a statement an else may follow
+    open_blocks = []
+    while len(output) < lines:
+        level = len(open_blocks)
+        indentation = '  ' * level
+        kind = rng.choice(kinds)
+        opens = level < depth and len(output) < lines - 1
+        if kind in ('tag', 'statement') and opens:
+            if kind == 'tag':
+                output.append(indentation + tag())
+            else:
+                statement = rng.choice(shortcuts['statements'])
+                output.append(indentation + statement.replace('*', rng.choice(WORDS)))
+            open_blocks.append(kind == 'statement')
+            continue
+        if kind == 'expression':
+            line = shortcuts['expression'].replace('*', rng.choice(WORDS))
+        elif kind == 'self_closing':
+            line = '> ' + tag()
+        elif kind == 'enclosing':
+            line = tag() + ' | ' + words(width // 2)
+        else:
+            line = rng.choice(shortcuts['text']).replace('*', words(width))
+        output.append(indentation + line)
+        # close some of the open blocks
+        level = rng.randint(0, level)
+        while len(open_blocks) > level:
+            statement = open_blocks.pop()
+            if (statement and rng.random() < 0.3 and len(output) < lines - 1):
+                output.append('  ' * len(open_blocks) + shortcuts['else'])
+                open_blocks.append(False)
+                break
+    return '\n'.join(output) + '\n'
+
+def measure(engine, remove_whitespace, text, repeat):
+    ''' Converts text, timing each stage separately; returns a dict
+    mapping stage names to the best time of repeat runs.
+    '''
+    
+    import aml, shpaml
+    module_name, class_name = ENGINES[engine]
+    template_engine = getattr(__import__(module_name), class_name)
+    converter = aml.Converter(template_engine, remove_whitespace)
+    finish = converter.finish_output
+    
+    def capture(records):
+        captured[:] = records
+        return []
+    captured = []
+    
+    stages = {}
+    def timed(stage, function, *args):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            result = function(*args)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        stages[stage] = best
+        return result
+    
+    pre = timed('convert_text_pre', template_engine.convert_text_pre, text)
+    timed('shpaml', shpaml.indent, pre,
+        converter.html_block_tag, converter.convert_line,
+        shpaml.PASS_SYNTAX, shpaml.FLUSH_LEFT_SYNTAX,
+        shpaml.FLUSH_LEFT_EMPTY_LINE, shpaml.find_indentation,
+        shpaml.get_indented_block, capture)
+    records = list(captured)
+    def finish_text():
+        return '\n'.join(finish(records)) + '\n'
+    if remove_whitespace:
+        converted = timed('whitespace_removal', finish_text)
+    else:
+        converted = timed('finish_output', finish_text)
+    timed('convert_text_post', template_engine.convert_text_post,
+        converted, remove_whitespace)
+    timed('total', converter.convert_text, text)
+    return stages
+
+def run_case(case, options):
+    # Measures one case in a child process, so that peak memory is that
+    # of the case alone. Returns the case with its results added.
+    import resource
+    
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            text = generate_template(case['engine'], case['lines'],
+                options.depth, options.width, options.attributes,
+                options.mix, options.seed)
+            stages = measure(case['engine'], case['remove_whitespace'],
+                text, options.repeat)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = {'bytes': len(text), 'stages': stages,
+                'peak_memory_kb': peak - start}
+            os.write(write_end, json.dumps(result).encode('utf-8'))
+        except:
+            import traceback
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    os.close(write_end)
+    data = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(read_end)
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('Benchmark %s failed' % case_name(case))
+    case = dict(case)
+    case.update(json.loads(b''.join(data).decode('utf-8')))
+    return case
+
+def case_name(case):
+    return '%s ws=%d lines=%d' % (case['engine'], case['remove_whitespace'], case['lines'])
+
+def scaling(results):
+    ''' Returns, for each engine, whitespace option and stage, the
+    exponent k of the fit time ~ lines ** k between the shortest and
+    the longest template. k near 1 is linear; 2 is quadratic.
+    '''
+    
+    import math
+    
+    series = {}
+    for result in results:
+        for stage, seconds in result['stages'].items():
+            key = '%s ws=%d %s' % (result['engine'], result['remove_whitespace'], stage)
+            series.setdefault(key, []).append((result['lines'], seconds))
+    exponents = {}
+    for key, points in series.items():
+        points.sort()
+        (first_lines, first), (last_lines, last) = points[0], points[-1]
+        if last_lines == first_lines or first <= 0 or last <= 0:
+            continue
+        exponents[key] = math.log(last / first) / math.log(float(last_lines) / first_lines)
+    return exponents
+
+def compare(results, baseline, tolerance):
+    # Returns descriptions of stages slower than in baseline by more
+    # than tolerance, a fraction of the baseline time.
+    previous = {}
+    for result in baseline['results']:
+        previous[case_name(result)] = result
+    regressions = []
+    for result in results:
+        old = previous.get(case_name(result))
+        if old is None:
+            continue
+        for stage, seconds in sorted(result['stages'].items()):
+            old_seconds = old['stages'].get(stage)
+            # differences under a millisecond are noise
+            if (old_seconds and seconds > old_seconds * (1 + tolerance)
+                    and seconds - old_seconds > 0.001):
+                regressions.append('%s %s: %.4fs, was %.4fs (%+.0f%%)' % (
+                    case_name(result), stage, seconds, old_seconds,
+                    (seconds / old_seconds - 1) * 100))
+    return regressions
+
+def measure_startup(engine, options):
+    # Returns the mean seconds per conversion of a template from the
+    # command line: cold, through the filter.py client of a daemon, and
+    # requested of the daemon by a running program.
+    import subprocess, tempfile, shutil, socket
+    
+    source_dir = os.path.join(root, options.source_dir)
+    script = os.path.join(source_dir, ENGINES[engine][0] + '.py')
+    client = os.path.join(source_dir, 'filter.py')
+    directory = tempfile.mkdtemp()
+    try:
+        input = os.path.join(directory, 'input.at')
+        output = os.path.join(directory, 'output.jt')
+        address = os.path.join(directory, 'daemon.sock')
+        f = open(input, 'w')
+        try:
+            f.write(generate_template(engine, options.lines[0], options.depth,
+                options.width, options.attributes, options.mix, options.seed))
+        finally:
+            f.close()
+        arguments = ['-o', output, input]
+        
+        def timed(command):
+            start = time.time()
+            for i in range(options.startup):
+                subprocess.check_call(command)
+            return (time.time() - start) / options.startup
+        
+        times = {'cold': timed([sys.executable, script] + arguments)}
+        daemon = subprocess.Popen([sys.executable, script, '--daemon', address],
+            stderr=open(os.devnull, 'w'))
+        try:
+            while not os.path.exists(address):
+                time.sleep(0.01)
+            times['client'] = timed([sys.executable, client, '--connect', address]
+                + arguments)
+            sys.path.insert(0, source_dir)
+            import filter
+            start = time.time()
+            for i in range(options.startup):
+                filter.request_conversion(address, arguments, input, None)
+            times['request'] = (time.time() - start) / options.startup
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(directory)
+    return times
+
+def parse_arguments():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-s', '--source-dir', metavar='DIR', default='src',
+        help='Benchmark the modules in DIR (default %default)')
+    parser.add_option('-e', '--engine', action='append', choices=sorted(ENGINES),
+        help='Benchmark ENGINE only (jinja or erb); may be repeated')
+    parser.add_option('-l', '--lines', metavar='N,...', default='1000,2000,4000,8000',
+        help='Template lengths in lines (default %default)')
+    parser.add_option('--depth', metavar='N', type='int', default=6,
+        help='Maximum nesting depth (default %default)')
+    parser.add_option('--width', metavar='N', type='int', default=40,
+        help='Length of text on a line (default %default)')
+    parser.add_option('--attributes', metavar='N', type='float', default=1.0,
+        help='Average number of attributes per tag (default %default)')
+    parser.add_option('--mix', metavar='KIND=WEIGHT,...',
+        help='Relative frequency of kinds of lines: %s' % ', '.join(
+            '%s=%d' % item for item in sorted(DEFAULT_MIX.items())))
+    parser.add_option('--seed', metavar='N', type='int', default=0,
+        help='Random seed for generated templates (default %default)')
+    parser.add_option('-r', '--repeat', metavar='N', type='int', default=3,
+        help='Report the best of N runs (default %default)')
+    parser.add_option('-o', '--output', metavar='FILE',
+        help='Save results as JSON to FILE')
+    parser.add_option('-b', '--baseline', metavar='FILE',
+        help='Compare results with those saved in FILE')
+    parser.add_option('-t', '--tolerance', metavar='FRACTION', type='float', default=0.25,
+        help='Report stages slower than the baseline by more than FRACTION (default %default)')
+    parser.add_option('--startup', metavar='N', type='int',
+        help='Time N conversions of a template of the first length from the command line, with and without a daemon')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        exit(2)
+    options.lines = [int(lines) for lines in options.lines.split(',')]
+    mix = dict(DEFAULT_MIX)
+    if options.mix:
+        for item in options.mix.split(','):
+            kind, weight = item.split('=')
+            if kind not in mix:
+                parser.error('Unknown kind of line: %s' % kind)
+            mix[kind] = int(weight)
+    options.mix = mix
+    return options
+
+def main():
+    options = parse_arguments()
+    sys.path.insert(0, os.path.join(root, options.source_dir))
+    engines = options.engine or sorted(ENGINES)
+    if options.startup:
+        for engine in engines:
+            times = measure_startup(engine, options)
+            sys.stdout.write('%-6s %d lines: %.4fs cold, %.4fs with filter.py --connect, '
+                '%.4fs per daemon request\n' % (engine, options.lines[0],
+                    times['cold'], times['client'], times['request']))
+        return
+    # imported before cases fork, so peak memory is that of conversion
+    for engine in engines:
+        __import__(ENGINES[engine][0])
+    
+    results = []
+    for engine in engines:
+        for remove_whitespace in (1, 0):
+            for lines in options.lines:
+                case = {'engine': engine, 'remove_whitespace': remove_whitespace,
+                    'lines': lines}
+                result = run_case(case, options)
+                results.append(result)
+                stages = result['stages']
+                sys.stdout.write('%-24s %8d bytes %8.4fs total, %7d KiB peak\n    %s\n' % (
+                    case_name(result), result['bytes'], stages['total'],
+                    result['peak_memory_kb'], ', '.join('%s %.4fs' % item
+                        for item in sorted(stages.items()) if item[0] != 'total')))
+    
+    exponents = scaling(results)
+    for key, exponent in sorted(exponents.items()):
+        if exponent > 1.3:
+            sys.stdout.write('Superlinear: %s grows as lines ** %.2f\n' % (key, exponent))
+    
+    report = {
+        'python': '%d.%d.%d' % sys.version_info[:3],
+        'settings': {
+            'depth': options.depth, 'width': options.width,
+            'attributes': options.attributes, 'mix': options.mix,
+            'seed': options.seed, 'repeat': options.repeat,
+        },
+        'results': results,
+        'scaling': exponents,
+    }
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline['settings'] != report['settings']:
+            sys.stdout.write('Warning: baseline was measured with other settings\n')
+        if baseline['python'] != report['python']:
+            sys.stdout.write('Warning: baseline was measured with Python %s\n'
+                % baseline['python'])
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            sys.stdout.write('Slower: %s\n' % regression)
+        if regressions:
+            exit(1)
+        sys.stdout.write('No stage is slower than the baseline\n')
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,28 @@ class TestAml(unittest.TestCase):
     
     def test_self_closing_block(self):
         self.run_test('self_closing_block')
+    
+    def test_separated_else(self):
+        self.run_test('separated_else')
+    
+    def test_unspaced_else(self):
+        self.run_test('unspaced_else')
+    
+    def test_stream(self):
+        for name in ('conditional', 'loop', 'self_closing_block', 'separated_else', 'unspaced_else'):
+            input = file_utils.read_file(os.path.join(input_dir, name + '.erb.shpaml'))
+            chunks = [input[i:i + 3] for i in range(0, len(input), 3)]
+            actual_output = ''.join(aml_erb.convert_stream(chunks))
+            expected_output = file_utils.read_file(os.path.join(output_dir, name + '.erb'))
+            self.assertEqual(expected_output, actual_output)
+
+    def test_parse_tree(self):
+        aml = getattr(aml_erb, 'aml', aml_erb)
+        for name in ('conditional', 'loop', 'self_closing_block', 'separated_else'):
+            input = file_utils.read_file(os.path.join(input_dir, name + '.erb.shpaml'))
+            tree = aml.ParseTree.loads(aml.parse_text(input).dumps())
+            expected_output = file_utils.read_file(os.path.join(output_dir, name + '.erb'))
+            self.assertEqual(expected_output, aml_erb.converter.render(tree))
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,4 @@
-import sys
+import sys, re
 import os.path, unittest
 import aml_jinja
 import file_utils
@@ -36,11 +36,539 @@ class TestAml(unittest.TestCase):
     def test_multi_elif_else(self):
         self.run_test('multi_elif_else')
     
+    def test_separated_elif_else(self):
+        self.run_test('separated_elif_else')
+    
+    def test_unspaced_else(self):
+        self.run_test('unspaced_else')
+    
     def test_self_closing_tag(self):
         self.run_test('self_closing_tag')
     
     def test_line_continuation(self):
         self.run_test('line_continuation')
+    
+    def test_deep_nesting(self):
+        depth = 500
+        lines = ['%s%% if x%d' % (' ' * level, level) for level in range(depth)]
+        lines.append(' ' * depth + 'foo')
+        actual_output = aml_jinja.convert_text('\n'.join(lines) + '\n')
+        self.assertEqual(depth, actual_output.count('{% endif %}'))
+    
+    def test_converter_without_whitespace_removal(self):
+        converter = aml_jinja.converter.__class__(aml_jinja.JinjaShortcuts, False)
+        self.assertEqual('<p>\n  text\n</p>\n', converter.convert_text('p\n  text\n'))
+        self.assertEqual('<p>text</p>\n', aml_jinja.convert_text('p\n  text\n'))
+    
+    def test_cache(self):
+        # single-file builds have no separate aml module
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        cache = aml.ConversionCache(max_bytes=40)
+        converter = aml.Converter(aml_jinja.JinjaShortcuts, cache=cache)
+        self.assertEqual('<p>text</p>\n', converter.convert_text('p\n  text\n'))
+        self.assertEqual('<p>text</p>\n', converter.convert_text('p\n  text\n'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        converter.convert_text('p\n  other text\n')
+        converter.convert_text('p\n  more text\n')
+        self.assertEqual(1, cache.evictions)
+        unremoved = aml.Converter(aml_jinja.JinjaShortcuts, False, cache)
+        self.assertEqual('<p>\n  text\n</p>\n', unremoved.convert_text('p\n  text\n'))
+        
+        compressed = aml.ConversionCache(compress=True)
+        converter.cache = compressed
+        converter.convert_text(u'p\n  text\n')
+        self.assertEqual(u'<p>text</p>\n', converter.convert_text(u'p\n  text\n'))
+        self.assertEqual(1, compressed.stats()['hits'])
+    
+    def test_block_cache(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        cache = aml.BlockCache(depth=2)
+        converter = aml.Converter(aml_jinja.JinjaShortcuts, block_cache=cache)
+        for name in ('conditional', 'elif_else', 'separated_elif_else'):
+            input = file_utils.read_file(os.path.join(input_dir, name + '.at'))
+            expected_output = file_utils.read_file(os.path.join(output_dir, name + '.jt'))
+            self.assertEqual(expected_output, converter.convert_text(input))
+            self.assertEqual(expected_output, converter.convert_text(input))
+            self.assertEqual(expected_output, ''.join(converter.convert_stream([input])))
+        self.assertTrue(cache.stats()['hit_rate'] > 0.5)
+        # the same block closes differently depending on what follows it
+        self.assertEqual('{% if a %}\nb\n{% endif %}\n',
+            converter.convert_text('% if a\n  b\n'))
+        self.assertEqual('{% if a %}\nb\n{% else %}\nc\n{% endif %}\n',
+            converter.convert_text('% if a\n  b\n% else\n  c\n'))
+        # converters with the same configuration share blocks
+        hits = cache.hits
+        other = aml.Converter(aml_jinja.JinjaShortcuts, block_cache=cache)
+        other.convert_text('% if a\n  b\n')
+        self.assertTrue(cache.hits > hits)
+        unremoved = aml.Converter(aml_jinja.JinjaShortcuts, False, block_cache=cache)
+        self.assertEqual('{% if a %}\n  b\n{% endif %}\n',
+            unremoved.convert_text('% if a\n  b\n'))
+        # conversions collecting statistics leave the cache alone
+        entries = cache.stats()['entries']
+        other.collect_stats()
+        other.convert_text('% if c\n  d\n')
+        self.assertEqual(entries, cache.stats()['entries'])
+    
+    def test_stats(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        converter = aml.Converter(aml_jinja.JinjaShortcuts)
+        stats = converter.collect_stats()
+        input = file_utils.read_file(os.path.join(input_dir, 'multi_elif_else.at'))
+        expected_output = file_utils.read_file(os.path.join(output_dir, 'multi_elif_else.jt'))
+        self.assertEqual(expected_output, converter.convert_text(input))
+        self.assertEqual(expected_output, ''.join(converter.convert_stream([input])))
+        result = stats.stats()
+        self.assertEqual(2, result['conversions'])
+        self.assertTrue(result['blocks'] > 0 and result['leaves'] > 0)
+        self.assertTrue(result['translators']['LINE_STATEMENT'][0] > 0)
+        self.assertTrue('whitespace_removal' in result['stages'])
+        self.assertTrue('LINE_STATEMENT' in stats.report())
+    
+    def test_memoized_tags_and_lines(self):
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        converter = aml_jinja.converter
+        hits = shpaml.apply_jquery_sugar.hits
+        line_hits = converter.convert_line.hits
+        text = 'div.row\n  td.num | 1\n  td.num | 1\ndiv.row\n  = x\n'
+        expected_output = '<div class="row"><td class="num">1</td>\n' \
+            '<td class="num">1</td></div>\n<div class="row">{{ x }}</div>\n'
+        self.assertEqual(expected_output, converter.convert_text(text))
+        self.assertEqual(expected_output, converter.convert_text(text))
+        self.assertTrue(shpaml.apply_jquery_sugar.hits > hits)
+        self.assertTrue(converter.convert_line.hits > line_hits)
+        self.assertTrue(shpaml.memo_stats()['apply_jquery_sugar']['hit_rate'] > 0)
+        unremoved = aml_jinja.converter.__class__(aml_jinja.JinjaShortcuts, False)
+        self.assertEqual('<div class="row">\n  {{ x }}\n</div>\n',
+            unremoved.convert_text('div.row\n  = x\n'))
+    
+    def test_tag_sugar(self):
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        self.assertEqual(('<a href="x" title=\'a b\' class="btn primary" id="go">', '</a>'),
+            shpaml.apply_jquery_sugar_uncached("a.btn.primary#go href=x title='a b'"))
+        self.assertEqual(('<div class="a.b c" id="x">', '</div>'),
+            shpaml.apply_jquery_sugar_uncached('.a..b#x.c'))
+        self.assertEqual('<img src="a=b" alt=\'it\\\'s />', shpaml.SELF_CLOSING_TAG(
+            shpaml.SELF_CLOSING_TAG.regex.match("> img src=a=b alt='it\\'s")))
+        # runs of spaces used to take quadratic time
+        start_tag = shpaml.apply_jquery_uncached('a' + ' ' * 100000 + 'b=c')[0]
+        self.assertTrue(start_tag.endswith(' b="c"'))
+    
+    def test_lone_shortcut(self):
+        # a line of nothing but a shortcut character does not swallow the next
+        self.assertEqual('{%%}\n{{}}', aml_jinja.JinjaShortcuts.convert_text_pre('%\n='))
+        self.assertEqual('{%%}\n{{}}\n', aml_jinja.convert_text('%\n=\n'))
+        self.assertEqual('<p>{{  }}\nb</p>\n', aml_jinja.convert_text('p\n  = \n  b\n'))
+    
+    def test_lazy_regex(self):
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        regex = shpaml.LazyRegex(r'^(\w+)', re.M)
+        self.assertFalse('sub' in regex.__dict__)
+        self.assertEqual('<a>\n<b>', regex.sub(r'<\1>', 'a\nb'))
+        self.assertEqual(1, regex.groups)
+        self.assertTrue('sub' in regex.__dict__)
+        classifier = shpaml.LineClassifier(shpaml.LINE_METHODS)
+        self.assertEqual(None, classifier.dispatch)
+        self.assertEqual('<p>x</p>', classifier.convert_line('p | x'))
+    
+    def test_configuration_key(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        key = aml_jinja.converter.configuration_key()
+        self.assertEqual(key, aml.Converter(aml_jinja.JinjaShortcuts).configuration_key())
+        unremoved = aml.Converter(aml_jinja.JinjaShortcuts, False)
+        self.assertNotEqual(key, unremoved.configuration_key())
+    
+    def test_loader(self):
+        try:
+            import jinja2, aml_jinja_loader
+        except ImportError:
+            # Jinja2 is optional and the loader is not part of single-file builds
+            self.skipTest('jinja2 or aml_jinja_loader is not available')
+        loader = aml_jinja_loader.AmlLoader(input_dir)
+        environment = jinja2.Environment(loader=loader, auto_reload=True)
+        template = environment.get_template('elif_else.at')
+        self.assertEqual('bar1', template.render(foo1=True).strip())
+        source, filename, uptodate = loader.get_source(environment, 'elif_else.at')
+        expected_output = file_utils.read_file(os.path.join(output_dir, 'elif_else.jt'))
+        self.assertEqual(expected_output, source)
+        self.assertTrue(uptodate())
+        # converted templates are kept within max_converted
+        loader = aml_jinja_loader.AmlLoader(input_dir, max_converted=200)
+        for name in sorted(os.listdir(input_dir)):
+            loader.get_source(environment, name)
+            loader.get_source(environment, name)
+        self.assertTrue(0 < loader.converted.size <= 200)
+        self.assertTrue(loader.converted.hits > 0)
+    
+    def test_precompile(self):
+        try:
+            import jinja2, aml_jinja_loader
+        except ImportError:
+            self.skipTest('jinja2 or aml_jinja_loader is not available')
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(directory, 'templates.zip')
+            aml_jinja_loader.precompile(input_dir, archive)
+            environment = jinja2.Environment(loader=jinja2.ModuleLoader(archive))
+            template = environment.get_template('elif_else.at')
+            self.assertEqual('bar1', template.render(foo1=True).strip())
+            
+            class Converter(object):
+                conversions = 0
+                def convert_text(self, text):
+                    self.conversions += 1
+                    return aml_jinja.convert_text(text)
+                def configuration_key(self):
+                    return aml_jinja.converter.configuration_key()
+            cache = jinja2.FileSystemBytecodeCache(os.path.join(directory, 'cache'))
+            os.mkdir(cache.directory)
+            aml_jinja_loader.precompile(input_dir, bytecode_cache=cache)
+            converter = Converter()
+            loader = aml_jinja_loader.AmlLoader(input_dir, converter=converter)
+            environment = jinja2.Environment(loader=loader, bytecode_cache=cache)
+            template = environment.get_template('elif_else.at')
+            self.assertEqual('bar1', template.render(foo1=True).strip())
+            self.assertEqual(0, converter.conversions)
+            self.assertTrue(template.is_up_to_date)
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_direct_parse(self):
+        try:
+            import jinja2, aml_jinja_loader
+        except ImportError:
+            self.skipTest('jinja2 or aml_jinja_loader is not available')
+        sources = [file_utils.read_file(os.path.join(output_dir, name))
+            for name in sorted(os.listdir(output_dir))]
+        sources += [
+            'a {{ b.c }} d\n{%- if e -%}\n\n  f\n{% endif %}\n',
+            '{% raw %}\n{{ a }}\n{% endraw %}\n{# b\n{{ c }} #}{{ d +\n e }}',
+            '{% if a %}\n{{ b }}\n',
+        ]
+        for options in [{}, dict(trim_blocks=True, lstrip_blocks=True),
+                dict(keep_trailing_newline=True, line_statement_prefix='#')]:
+            environment = jinja2.Environment(**options)
+            for source in sources:
+                try:
+                    expected = environment.compile(source, raw=True)
+                except jinja2.TemplateSyntaxError as e:
+                    expected = (e.lineno, e.message)
+                try:
+                    actual = environment.compile(
+                        aml_jinja_loader.parse_template(environment, source), raw=True)
+                except jinja2.TemplateSyntaxError as e:
+                    actual = (e.lineno, e.message)
+                self.assertEqual(expected, actual)
+        loader = aml_jinja_loader.AmlLoader(input_dir, direct=True)
+        environment = jinja2.Environment(loader=loader)
+        template = environment.get_template('elif_else.at')
+        self.assertEqual('bar1', template.render(foo1=True).strip())
+        # other versions of Jinja2 parse templates as usual
+        self.assertTrue(aml_jinja_loader.supports_direct_parsing('2.11.3'))
+        self.assertFalse(aml_jinja_loader.supports_direct_parsing('2.10'))
+        self.assertFalse(aml_jinja_loader.supports_direct_parsing('3.1.2'))
+        version = jinja2.__version__
+        jinja2.__version__ = '3.1.2'
+        try:
+            self.assertRaises(ValueError, aml_jinja_loader.AmlLoader, input_dir, direct=True)
+            source = '{% if a %}\n{{ b }}\n{% endif %}\n'
+            self.assertEqual(environment.compile(source, raw=True),
+                environment.compile(aml_jinja_loader.parse_template(environment, source), raw=True))
+        finally:
+            jinja2.__version__ = version
+    
+    def test_default_converter(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        # importing an engine configures aml unless configure was called
+        self.assertTrue(aml.configuration.converter is not None)
+        converter = aml.configuration.converter
+        try:
+            aml.configuration.converter = None
+            aml.configure_default(aml_jinja.converter)
+            aml.configure_default(aml.Converter(aml_jinja.JinjaShortcuts, False))
+            self.assertEqual('{% if a %}\n<p>b</p>\n{% endif %}\n',
+                aml.convert_text('% if a\n  p | b\n'))
+        finally:
+            aml.configuration.converter = converter
+    
+    def test_nesting_error(self):
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        depth = shpaml.MAX_NESTING_DEPTH
+        shpaml.MAX_NESTING_DEPTH = 3
+        try:
+            # errors give the line in the template, wherever its block starts
+            input = 'p | a\n\nul\n  li | b\n' + ''.join(['  ' * i + 'div\n' for i in range(6)])
+            for convert in (aml_jinja.convert_text,
+                    lambda text: ''.join(aml_jinja.convert_stream([text])),
+                    lambda text: aml_jinja.converter.convert_part(text[text.index('div'):], None, 4)):
+                try:
+                    convert(input)
+                except shpaml.NestingError:
+                    self.assertTrue(str(sys.exc_info()[1]).endswith(' at line 9'))
+                else:
+                    self.fail('NestingError not raised')
+        finally:
+            shpaml.MAX_NESTING_DEPTH = depth
+    
+    def test_parse_tree(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        unremoved = aml.Converter(aml_jinja.JinjaShortcuts, False)
+        for name in ('multi_elif_else', 'separated_elif_else', 'line_continuation'):
+            input = file_utils.read_file(os.path.join(input_dir, name + '.at'))
+            tree = aml.ParseTree.loads(aml.parse_text(input).dumps())
+            expected_output = file_utils.read_file(os.path.join(output_dir, name + '.jt'))
+            self.assertEqual(expected_output, aml_jinja.converter.render(tree))
+            self.assertEqual(unremoved.convert_text(input), unremoved.render(tree))
+        tree = aml.parse_text('% if a\n  b | c\n\n% else\n  PASS\n')
+        self.assertEqual([aml.LINE_SHORTCUT, aml.LINE_MARKUP, aml.LINE_BLANK,
+            aml.LINE_SHORTCUT, aml.LINE_PASS], list(tree.kinds))
+        self.assertEqual([0, 3], list(tree.children()))
+        self.assertEqual([4], list(tree.children(3)))
+        self.assertRaises(ValueError, aml.ParseTree.loads, 'AMLT'.encode('ascii'))
+    
+    def test_compact_lines(self):
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        min_size = shpaml.COMPACT_LINES_MIN_SIZE
+        shpaml.COMPACT_LINES_MIN_SIZE = 0
+        try:
+            for name in ('multi_elif_else', 'separated_elif_else', 'self_closing_tag'):
+                input = file_utils.read_file(os.path.join(input_dir, name + '.at'))
+                expected_output = file_utils.read_file(os.path.join(output_dir, name + '.jt'))
+                self.assertEqual(expected_output, aml_jinja.converter.convert_text_uncached(input))
+            lines = shpaml.compact_lines('a\n  b  \n\n  c\nd\n \n')
+            self.assertEqual([('', 'a'), ('  ', 'b'), ('', ''), ('  ', 'c'), ('', 'd')], list(lines))
+            self.assertEqual([4, 2, 0, 4, 5], list(lines.ends))
+            # tab indentation is left to the tuple representation
+            self.assertEqual('\n', aml_jinja.converter.convert_text_uncached('  PASS\n'))
+            self.assertEqual(None, shpaml.compact_lines('a\n\tb\n'))
+            self.assertEqual('<a>\n\tb\n</a>\n', shpaml.convert_shpaml_tree('a\n\tb\n'))
+        finally:
+            shpaml.COMPACT_LINES_MIN_SIZE = min_size
+    
+    def test_parallel(self):
+        aml = getattr(aml_jinja, 'aml', aml_jinja)
+        input = ''.join(file_utils.read_file(os.path.join(input_dir, name + '.at'))
+            for name in ('multi_elif_else', 'separated_elif_else', 'line_continuation')) * 20
+        for remove_whitespace in (True, False):
+            converter = aml.Converter(aml_jinja.JinjaShortcuts, remove_whitespace)
+            self.assertEqual(converter.convert_text(input), converter.convert_parallel(input, 3))
+        # parts are joined like whitespace removal joins tags
+        shpaml = getattr(aml_jinja, 'shpaml', aml_jinja)
+        results = [('<a>', shpaml.OUTPUT_START_TAG, shpaml.OUTPUT_START_TAG),
+            (None, None, None), ('x</a>', shpaml.OUTPUT_LINE, shpaml.OUTPUT_END_TAG)]
+        self.assertEqual('<a>x</a>\n', aml_jinja.converter.join_parts(results))
+        self.assertTrue(len(aml.split_top_level(input, 12)) > 6)
+    
+    def test_daemon(self):
+        try:
+            import filter
+        except ImportError:
+            # single-file packages include filter
+            filter = aml_jinja
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        import json
+        requests = [
+            {'arguments': [], 'stdin': '% if x\n    p\n', 'requestId': 1},
+            {'arguments': [os.path.join(input_dir, 'elif.at')], 'cwd': self_dir},
+            {'arguments': ['--daemon', '-']},
+        ]
+        reader = StringIO('\n'.join([json.dumps(r) for r in requests] + ['', 'x', '']))
+        writer = StringIO()
+        settings = filter.ConversionSettings(aml_jinja.convert_stream, stream=True)
+        filter.serve_stream(reader, writer, settings)
+        responses = [json.loads(line) for line in writer.getvalue().splitlines()]
+        self.assertEqual(4, len(responses))
+        self.assertEqual({'exitCode': 0, 'output': '', 'requestId': 1,
+            'stdout': '{% if x %}\np\n{% endif %}\n'}, responses[0])
+        expected_output = file_utils.read_file(os.path.join(output_dir, 'elif.jt'))
+        self.assertEqual(expected_output, responses[1]['stdout'])
+        self.assertEqual(2, responses[2]['exitCode'])
+        self.assertEqual(2, responses[3]['exitCode'])
+    
+    def test_batch(self):
+        try:
+            import filter
+        except ImportError:
+            filter = aml_jinja
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        stderr = sys.stderr
+        try:
+            # the directory and the pattern name the same files
+            paths = [input_dir, os.path.join(input_dir, '*.at')]
+            files = filter.find_files(paths, directory, ('.at', '.jt'))
+            names = sorted(os.listdir(input_dir))
+            self.assertEqual(len(names), len(files))
+            sys.stderr = StringIO()
+            filter.perform_conversion(aml_jinja.convert_stream, stream=True,
+                extensions=('.at', '.jt'), args=['-d', directory, '-j', '2'] + paths)
+            report = sys.stderr.getvalue()
+            sys.stderr = stderr
+            self.assertTrue('Converted %d of %d files' % (len(names), len(names)) in report)
+            for name in names:
+                name = name[:-len('.at')] + '.jt'
+                expected_output = file_utils.read_file(os.path.join(output_dir, name))
+                actual_output = file_utils.read_file(os.path.join(directory, name))
+                self.assertEqual(expected_output, actual_output)
+        finally:
+            sys.stderr = stderr
+            shutil.rmtree(directory)
+    
+    def test_stream_output(self):
+        try:
+            import filter
+        except ImportError:
+            filter = aml_jinja
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            input = os.path.join(directory, 'input.at')
+            output = os.path.join(directory, 'output.jt')
+            for name, text in ((input, 'p | a\n\np\n\tb\n'), (output, 'old\n')):
+                f = open(name, 'w')
+                try:
+                    f.write(text)
+                finally:
+                    f.close()
+            # output is replaced only once the whole input is converted
+            self.assertRaises(ValueError, filter.perform_conversion,
+                aml_jinja.convert_stream, stream=True, args=['-o', output, input])
+            self.assertEqual('old\n', file_utils.read_file(output))
+            self.assertEqual(['input.at', 'output.jt'], sorted(os.listdir(directory)))
+            f = open(input, 'w')
+            try:
+                f.write('p | a\n')
+            finally:
+                f.close()
+            filter.perform_conversion(aml_jinja.convert_stream, stream=True,
+                args=['-o', output, input])
+            self.assertEqual('<p>a</p>\n', file_utils.read_file(output))
+            self.assertEqual(['input.at', 'output.jt'], sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_disk_cache(self):
+        try:
+            import filter
+        except ImportError:
+            filter = aml_jinja
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(directory, 'cache')
+            input = os.path.join(directory, 'input.at')
+            output = os.path.join(directory, 'output.jt')
+            conversions = []
+            def convert(text):
+                conversions.append(text)
+                return aml_jinja.convert_text(text)
+            def write(text):
+                f = open(input, 'w')
+                try:
+                    f.write(text)
+                finally:
+                    f.close()
+            def run(cache_key):
+                filter.perform_conversion(convert, cache_key=cache_key,
+                    args=['--cache-dir', cache_dir, '-o', output, input])
+                return file_utils.read_file(output)
+            write('p\n  text\n')
+            self.assertEqual('<p>text</p>\n', run('a'))
+            self.assertEqual('<p>text</p>\n', run('a'))
+            self.assertEqual(1, len(conversions))
+            # a different configuration or source misses
+            self.assertEqual('<p>text</p>\n', run('b'))
+            self.assertEqual(2, len(conversions))
+            write('p\n  other\n')
+            self.assertEqual('<p>other</p>\n', run('b'))
+            self.assertEqual(3, len(conversions))
+            
+            cache = filter.DiskCache(cache_dir)
+            key = cache.key('a', u'p\n  text\n')
+            self.assertEqual(key, cache.key('a', 'p\n  text\n'.encode('ascii')))
+            self.assertNotEqual(key, cache.key('a', 'p\n  text\n', None, None))
+            self.assertEqual(None, cache.get(cache.key('c', 'p\n  text\n')))
+            # text of the native string type, also under Python 3
+            cache.put(key, u'<p>caf\xe9</p>\n')
+            text = cache.get(key)
+            self.assertTrue(isinstance(text, str))
+            self.assertEqual(u'<p>caf\xe9</p>\n'.encode('utf-8'),
+                text if isinstance(text, bytes) else text.encode('utf-8'))
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_watch_polling(self):
+        try:
+            import filter
+        except ImportError:
+            filter = aml_jinja
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        stderr = sys.stderr
+        try:
+            input = os.path.join(directory, 'input.at')
+            output = os.path.join(directory, 'output.jt')
+            def write(text):
+                f = open(input, 'w')
+                try:
+                    f.write(text)
+                finally:
+                    f.close()
+            write('p\n  text\n')
+            # the first poll finds the input changed, the second stops watching
+            calls = []
+            def list_files():
+                calls.append(None)
+                if len(calls) == 3:
+                    write('p\n  changed text\n')
+                elif len(calls) == 4:
+                    raise KeyboardInterrupt
+                return [(input, output)]
+            input_name, output_name, options = filter.parse_arguments(
+                ['-w', '--poll', '0.01', '-o', output, input])
+            sys.stderr = StringIO()
+            filter.watch_conversion(aml_jinja.convert_text, list_files, options,
+                False, False, False, None, None, None)
+            report = sys.stderr.getvalue()
+            sys.stderr = stderr
+            self.assertEqual('<p>changed text</p>\n', file_utils.read_file(output))
+            self.assertEqual(2, report.count(' -> '))
+            self.assertTrue('Watching 1 files' in report)
+        finally:
+            sys.stderr = stderr
+            shutil.rmtree(directory)
+    
+    def test_stream_pass_block(self):
+        # lines nested in a PASS block belong to the same top-level block
+        input = '  p\nPASS\n  % if x\n    b\n'
+        self.assertEqual(aml_jinja.convert_text(input),
+            ''.join(aml_jinja.convert_stream([input])))
+    
+    def test_stream(self):
+        for name in ('multi_elif_else', 'separated_elif_else',
+                'line_continuation', 'self_closing_tag'):
+            input = file_utils.read_file(os.path.join(input_dir, name + '.at'))
+            chunks = [input[i:i + 3] for i in range(0, len(input), 3)]
+            actual_output = ''.join(aml_jinja.convert_stream(chunks))
+            expected_output = file_utils.read_file(os.path.join(output_dir, name + '.jt'))
+            self.assertEqual(expected_output, actual_output)
+        # lone shortcut characters, which used to swallow the next line
+        for input in ('= \n', '%\n=\n', 'p\n  ~\n  b\n', '= \\\n  x\n'):
+            self.assertEqual(aml_jinja.convert_text(input),
+                ''.join(aml_jinja.convert_stream([input])))
+        self.assertEqual('{{  }}\n', ''.join(aml_jinja.convert_stream(['= \n'])))
 
 if __name__ == '__main__':
     unittest.main()
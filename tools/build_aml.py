@@ -20,30 +20,21 @@ def move_main(text):
     return text_re.sub(r'\1\n\6\2', text)
 
 def strip_modules(text, modules):
-    kill_modules, keep_modules = [], []
-    for module in modules:
-        if re.search(r'hook_module_function\(%s' % module, text):
-            keep_modules.append(module)
-        else:
-            kill_modules.append(module)
-    
-    modules = '('+'|'.join(keep_modules)+')'
-    import_re = re.compile(r'^(\s*)import %s\n' % '(shpaml)', re.M)
-    # usage of hook_module_function necessitates this ugly hack
-    text = import_re.sub(r'\1import sys\n\1\2 = sys.modules[__name__]\n', text)
-    
-    modules = '('+'|'.join(kill_modules)+')'
+    modules = '('+'|'.join(modules)+')'
     import_re = re.compile(r'^\s*import %s\n' % modules, re.M)
     text = import_re.sub('', text)
     use_re = re.compile(r'\b%s\.(\w)' % modules)
     text = use_re.sub(r'\2', text)
     return text
 
-def fix_convert_text_callers(text):
-    return re.compile(r'\b(\w+)\.convert_text(\(|$)', re.M).sub(r'convert_text_\1\2', text)
+def fix_convert_text_callers(text, modules):
+    modules = '('+'|'.join(modules)+')'
+    return re.compile(r'\b%s\.convert_text(\(|$)' % modules, re.M).sub(r'convert_text_\1\2', text)
 
 def rename_convert_text(text, module):
-    return re.sub(r'\bconvert_text\b', 'convert_text_' + module, text)
+    # methods named convert_text are left alone
+    return re.sub(r'(?m)(?<![\w.])(?<!def )convert_text\b|(?<=^def )convert_text\b',
+        'convert_text_' + module, text)
 
 sources = args
 if options.output:
@@ -60,10 +51,37 @@ if options.main:
 else:
     main = module_names[sources[0]]
 
+def order_sources(sources):
+    # Modules use each other at import time, so each module is placed
+    # after the modules it imports, otherwise keeping the given order.
+    imports = {}
+    for source in sources:
+        # docstrings show imports in examples
+        code = re.sub(r'(?s)\'\'\'.*?\'\'\'', '', file_utils.read_file(source))
+        imported = re.findall(r'(?m)^import ([\w, ]+)$', code)
+        imports[source] = [module.strip() for line in imported for module in line.split(',')]
+    paths = {}
+    for source in sources:
+        paths[module_names[source]] = source
+    ordered = []
+    def place(source, pending):
+        if source in ordered or source in pending:
+            return
+        pending = pending + [source]
+        for module in imports[source]:
+            if module in paths:
+                place(paths[module], pending)
+        ordered.append(source)
+    for source in sources:
+        place(source, [])
+    return ordered
+
+sources = order_sources(sources)
+
 text = ''
 for source in sources:
     module = module_names[source]
-    content = fix_convert_text_callers(file_utils.read_file(source))
+    content = fix_convert_text_callers(file_utils.read_file(source), module_names.values())
     if module == main:
         text += content
     else: